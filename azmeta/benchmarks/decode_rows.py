@@ -0,0 +1,92 @@
+"""Time decoding Kusto row data into a DataFrame.
+
+Builds ROWS rows of 20 mixed-type columns (every other column with some nulls) and times
+kusto_data_to_dataframe on the row lists and kusto_columns_to_dataframe on ColumnBuffers, against
+the earlier decoder that built each column from a generator over the rows as a baseline.
+
+    python benchmarks/decode_rows.py [--rows 1000000] [--repeat 3]
+"""
+import argparse
+import time
+
+from pandas import DataFrame, Series
+
+from azmeta.access.kusto import (
+    ColumnBuffer,
+    KustoColumnDescriptor,
+    kusto_columns_to_dataframe,
+    kusto_data_to_dataframe,
+)
+
+_TYPES = ['long', 'real', 'string', 'bool', 'int', 'datetime', 'guid', 'timespan', 'real', 'string'] * 2
+
+_BASELINE_DTYPES = {
+    'bool': 'boolean',
+    'datetime': 'string',
+    'guid': 'string',
+    'int': 'Int32',
+    'long': 'Int64',
+    'real': 'float64',
+    'string': 'string',
+    'timespan': 'string',
+}
+
+
+def _baseline_data_to_dataframe(columns, rows) -> DataFrame:
+    # The decoder before columns were transposed in blocks and converted with numpy.
+    series = {
+        name: Series((x[index] for x in rows), dtype=_BASELINE_DTYPES[kdtype])
+        for index, (name, kdtype) in enumerate(columns)
+    }
+    return DataFrame(series)
+
+
+def _value(kusto_datatype: str, row: int, nullable: bool):
+    if nullable and row % 97 == 0:
+        return None
+    if kusto_datatype == 'long':
+        return row * 3
+    if kusto_datatype == 'int':
+        return row % 1000
+    if kusto_datatype == 'real':
+        return row * 0.5
+    if kusto_datatype == 'bool':
+        return row % 2 == 0
+    if kusto_datatype == 'datetime':
+        return f'2021-01-{row % 28 + 1:02}T{row % 24:02}:00:00Z'
+    if kusto_datatype == 'timespan':
+        return f'00:{row % 60:02}:00'
+    if kusto_datatype == 'guid':
+        return f'00000000-0000-0000-0000-{row % 1000:012}'
+    return f'value-{row % 5000}'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    columns = [KustoColumnDescriptor(f'c{i}', t) for i, t in enumerate(_TYPES)]
+    rows = [[_value(t, row, i % 2 == 0) for i, t in enumerate(_TYPES)] for row in range(args.rows)]
+    buffers = [ColumnBuffer(c.type) for c in columns]
+    for row in rows:
+        for buffer, value in zip(buffers, row):
+            buffer.append(value)
+    print(f'{args.rows} rows x {len(columns)} columns')
+
+    for name, decode in (
+        ('baseline (generator per column)', lambda: _baseline_data_to_dataframe(columns, rows)),
+        ('kusto_data_to_dataframe', lambda: kusto_data_to_dataframe(columns, rows)),
+        ('kusto_columns_to_dataframe', lambda: kusto_columns_to_dataframe(columns, buffers)),
+    ):
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            decode()
+            timings.append(time.perf_counter() - started)
+        print(f'{name}: best {min(timings):.2f}s of {args.repeat}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,13 +3,16 @@ from azure.mgmt.advisor import AdvisorManagementClient
 from azure.mgmt.advisor.models import ResourceRecommendationBase
 from typing import Iterable, Union, Iterable, Dict, List
 from itertools import chain
+from .utils.throttling import ApiFamily, scheduled_call
 
 def load_resize_recommendations(subscriptions: Union[str, Iterable[str]]) -> Dict[str,ResourceRecommendationBase]:
     target_subscriptions: Iterable[str] = [subscriptions] if isinstance(subscriptions, str) else subscriptions
 
     def get_iter_for_sub(subscription: str) ->  Iterable[ResourceRecommendationBase]:
         client = default_sdk_client(AdvisorManagementClient, subscription_id=subscription)
-        return client.recommendations.list(filter="Category eq 'Cost'")
+        return scheduled_call(
+            ApiFamily.arm, lambda: list(client.recommendations.list(filter="Category eq 'Cost'"))
+        )
     
     recommendations = chain.from_iterable(get_iter_for_sub(s) for s in target_subscriptions)
     vm_resize_type_id = 'e10b1381-5f0a-47ff-8c7b-37bd13d7c974'
@@ -4,13 +4,21 @@ from azure.mgmt.costmanagement import CostManagementClient
 from azure.mgmt.billing import BillingManagementClient
 from azure.mgmt.billing.models import BillingPeriod
 from azmeta.access import AzureBillingAccount, AzureSubscriptionHandle
-from typing import List, Sequence, Tuple, Union
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple, TypeVar, Union
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+from msrest.exceptions import ClientRequestError, HttpOperationError
 from msrest.pipeline import ClientRawResponse
-from pandas import DataFrame
-from .kusto import KustoColumnDescriptor, kusto_data_to_dataframe
+from pandas import DataFrame, Series, concat, factorize, to_datetime
+from .cache import default_result_cache, result_cache_key
+from .kusto import ColumnBuffer, KustoColumnDescriptor, KustoDecodeOptions, kusto_columns_to_dataframe
+from .utils.concurrency import map_bounded
+from .utils.throttling import ApiFamily, ThrottledError, default_request_scheduler, scheduled_call
+import copy
+import functools
 import json
 import itertools
+import time
 
 from azure.mgmt.costmanagement.models import (
     QueryDefinition,
@@ -24,6 +32,7 @@ from azure.mgmt.costmanagement.models import (
     QueryColumnType,
     QueryComparisonExpression,
     QueryResult,
+    ErrorResponseException,
 )
 
 # Monkey Patch Bug in API Swagger
@@ -36,7 +45,7 @@ def get_billing_accounts() -> List[AzureBillingAccount]:
     url = service_client.format_url("/providers/Microsoft.Billing/billingAccounts")
     query_parameters = {"api-version": "2019-10-01-preview"}
     request = service_client.get(url, query_parameters)
-    response = service_client.send(request, stream=False)
+    response = scheduled_call(ApiFamily.arm, lambda: service_client.send(request, stream=False))
     if response.status_code != 200:
         raise Exception("Failed to enumerate billing accounts.")
     raw_accounts = json.loads(response.content)["value"]
@@ -49,18 +58,27 @@ def get_billing_accounts() -> List[AzureBillingAccount]:
 
 def get_billing_periods(limit: int = 12) -> List[BillingPeriod]:
     billing_client = default_sdk_client(BillingManagementClient)
-    return list(itertools.islice(billing_client.billing_periods.list(top=limit), limit))
+    return scheduled_call(
+        ApiFamily.arm, lambda: list(itertools.islice(billing_client.billing_periods.list(top=limit), limit))
+    )
 
 
 def get_last_closed_billing_period() -> BillingPeriod:
     periods = iter(get_billing_periods(limit=3))
-    today = date.today()
     active_period = next(periods)
-    while today < (active_period.billing_period_end_date + timedelta(days=5)):
+    while not is_billing_period_closed(active_period):
         active_period = next(periods)
     return active_period
 
 
+def is_billing_period_closed(period: BillingPeriod) -> bool:
+    # Charges keep arriving for a few days after a period ends.
+    return date.today() >= (period.billing_period_end_date + _LATE_ARRIVAL_WINDOW)
+
+
+_LATE_ARRIVAL_WINDOW = timedelta(days=5)
+
+
 def billing_period_to_full_day_timespan(period: BillingPeriod) -> Tuple[datetime, datetime]:
     return full_day_timespan(period.billing_period_start_date, period.billing_period_end_date)
 
@@ -115,34 +133,350 @@ class GroupByColumn(GroupByBase):
         self._value = column_name
 
 
+class CostQueryTooLargeError(RuntimeError):
+    """A cost query needs more than max_pages pages, even when sharded."""
+
+
+class CostTimePartition(str, Enum):
+    day = "day"
+    month = "month"
+    billing_period = "billing_period"
+
+
 def query_cost_native(
-    scope: Union[AzureBillingAccount, AzureSubscriptionHandle], query: QueryDefinition, max_pages: int = 10
+    scope: Union[AzureBillingAccount, AzureSubscriptionHandle],
+    query: QueryDefinition,
+    max_pages: int = 10,
+    partition: Optional[CostTimePartition] = None,
+    max_concurrency: int = 1,
+    shard_dimension: Optional[str] = None,
 ) -> List[QueryResult]:
-    return _query_cost_native(scope, query, max_pages)
+    windows = _query_cost_partitioned(
+        _query_cost_native, scope, query, max_pages, partition, max_concurrency, shard_dimension
+    )
+    reaggregate = not _is_grouped_by(query, _resolve_shard_dimension(scope, shard_dimension))
+    results = []
+    for shards in windows:
+        pages = [page for shard in shards for page in shard]
+        results.extend([_sum_query_results(query, pages)] if reaggregate and len(shards) > 1 else pages)
+    return results
 
 
 def query_cost_dataframe(
-    scope: Union[AzureBillingAccount, AzureSubscriptionHandle], query: QueryDefinition, max_pages: int = 10
+    scope: Union[AzureBillingAccount, AzureSubscriptionHandle],
+    query: QueryDefinition,
+    max_pages: int = 10,
+    cache: Optional[bool] = None,
+    decode_options: Optional[KustoDecodeOptions] = None,
+    partition: Optional[CostTimePartition] = None,
+    max_concurrency: int = 1,
+    shard_dimension: Optional[str] = None,
 ) -> DataFrame:
-    responses = _query_cost_native(scope, query, max_pages)
-
-    columns = [
-        KustoColumnDescriptor(c.name, _COST_MANAGEMENT_TO_KUSTO_TYPE_MAP[c.type])
-        for c in responses[0].columns
-    ]
-    rows = itertools.chain.from_iterable(r.rows for r in responses)
-
-    return kusto_data_to_dataframe(columns, rows)
+    """Run a cost query and return its rows as a DataFrame.
+
+    With partition set, the custom time period of the query is split into day, month or billing
+    period windows (see split_cost_query) that are queried max_concurrency at a time, each retried
+    on its own, and concatenated in time order.
+
+    A query (or window) that needs more than max_pages pages is sharded on shard_dimension
+    (SubscriptionId for billing accounts and ResourceGroupName for subscriptions by default): it is
+    run once per group of the dimension's values, max_concurrency at a time, and the rows are
+    concatenated. When the query is not grouped by the shard dimension, shards return partial rows
+    for the same keys, so the aggregated columns are then summed over the other columns. A group that
+    is still too large is split in half. CostQueryTooLargeError is raised when a single value is, or
+    when some of the cost has no value for the shard dimension.
+    """
+    result_cache = default_result_cache(cache)
+    if result_cache:
+        cache_key = result_cache_key(
+            "billing", query.serialize(), scope.resource_id(), options=decode_options
+        )
+        tables = result_cache.get(cache_key)
+        if tables is not None:
+            return tables[0]
 
+    windows = _query_cost_partitioned(
+        _query_cost_columns, scope, query, max_pages, partition, max_concurrency, shard_dimension
+    )
+    results = [result for shards in windows for result in shards]
+    columns, buffers = results[0]
+    for _, window_buffers in results[1:]:
+        for buffer, window_buffer in zip(buffers, window_buffers):
+            buffer.extend(window_buffer)
+
+    dataframe = kusto_columns_to_dataframe(columns, buffers, decode_options)
+    if "UsageDate" in dataframe and not (decode_options and decode_options.temporal_as_string):
+        dataframe["UsageDate"] = _usage_date_series(dataframe["UsageDate"])
+    if len(results) > len(windows) and not _is_grouped_by(
+        query, _resolve_shard_dimension(scope, shard_dimension)
+    ):
+        dataframe = _sum_cost_rows(query, dataframe)
+    if result_cache:
+        result_cache.put(cache_key, [dataframe], immutable=_is_closed_time_period(query))
+    return dataframe
+
+
+def _is_closed_time_period(query: QueryDefinition) -> bool:
+    # Custom time periods that ended before the late-arrival window are immutable.
+    if query.time_period is None:
+        return False
+    return date.today() >= (query.time_period.to.date() + _LATE_ARRIVAL_WINDOW)
+
+
+def _usage_date_series(usage_date: Series) -> Series:
+    # Daily results report UsageDate as a yyyymmdd number.
+    days = usage_date.to_numpy(dtype="float64")
+    parts = {"year": days // 10000, "month": days // 100 % 100, "day": days % 100}
+    return to_datetime(DataFrame(parts, index=usage_date.index), utc=True)
+
+
+_COST_MANAGEMENT_TO_KUSTO_TYPE_MAP = {"Number": "real", "String": "string", "Datetime": "datetime"}
+
+
+def split_cost_query(
+    query: QueryDefinition,
+    partition: CostTimePartition,
+    billing_periods: Optional[Sequence[BillingPeriod]] = None,
+) -> List[QueryDefinition]:
+    """Split a query with a custom time period into one query per day, month or billing period window.
+
+    Windows are clipped to the time period. Queries must have Daily or Monthly granularity (Daily for
+    day windows) so the rows of the windows add up to the rows of the whole query. Billing period
+    windows use billing_periods, or get_billing_periods() when not given; they must reach back to the
+    start of the time period.
+    """
+    if query.time_period is None:
+        raise ValueError("Only queries with a custom time period can be partitioned.")
+    allowed = (
+        (GranularityType.daily,)
+        if partition == CostTimePartition.day
+        else (GranularityType.daily, GranularityType.monthly)
+    )
+    if query.dataset.granularity not in allowed:
+        raise ValueError(
+            f"Partitioning by {partition.value} requires {' or '.join(g.value for g in allowed)} granularity."
+        )
 
-_COST_MANAGEMENT_TO_KUSTO_TYPE_MAP = {"Number": "real", "String": "string"}
+    start = query.time_period.from_property
+    end = query.time_period.to
+    if partition == CostTimePartition.billing_period:
+        if billing_periods is None:
+            # The most recent periods are returned, so fetch enough to reach back to start.
+            today = date.today()
+            billing_periods = get_billing_periods(
+                limit=max(12, (today.year - start.year) * 12 + today.month - start.month + 2)
+            )
+        # Boundaries take the time period's time zone so that they compare with aware times too.
+        period_starts = [p.billing_period_start_date for p in billing_periods]
+        boundaries = sorted(datetime(d.year, d.month, d.day, tzinfo=start.tzinfo) for d in period_starts)
+        if not boundaries or boundaries[0] > start:
+            raise ValueError("The billing periods do not reach back to the start of the time period.")
+    else:
+        boundaries = []
+
+    queries = []
+    window_start = start
+    while window_start <= end:
+        midnight = window_start.replace(hour=0, minute=0, second=0, microsecond=0)
+        if partition == CostTimePartition.day:
+            next_start = midnight + timedelta(days=1)
+        elif partition == CostTimePartition.month:
+            next_start = midnight.replace(
+                year=window_start.year + window_start.month // 12, month=window_start.month % 12 + 1, day=1
+            )
+        else:
+            next_start = next((b for b in boundaries if b > window_start), end + timedelta(seconds=1))
+        window_end = min(end, next_start - timedelta(seconds=1))
+        window_query = copy.copy(query)
+        window_query.time_period = QueryTimePeriod(from_property=window_start, to=window_end)
+        queries.append(window_query)
+        window_start = next_start
+    return queries
+
+
+R = TypeVar("R")
+
+
+def _query_cost_partitioned(
+    query_native: Callable[[Union[AzureBillingAccount, AzureSubscriptionHandle], QueryDefinition, int], R],
+    scope: Union[AzureBillingAccount, AzureSubscriptionHandle],
+    query: QueryDefinition,
+    max_pages: int,
+    partition: Optional[CostTimePartition],
+    max_concurrency: int,
+    shard_dimension: Optional[str],
+) -> List[List[R]]:
+    # Returns the results of query_native for each time window (one per shard), in time order.
+    query_sharded = functools.partial(
+        _query_cost_sharded,
+        query_native,
+        scope,
+        max_pages=max_pages,
+        shard_dimension=shard_dimension,
+        max_concurrency=max_concurrency,
+    )
+    if partition is None:
+        return [query_sharded(query)]
+
+    def query_window(window_query: QueryDefinition) -> List[R]:
+        attempt = 0
+        while True:
+            try:
+                return query_sharded(window_query)
+            except Exception as error:
+                if not _is_transient_error(error) or attempt == _WINDOW_RETRIES:
+                    raise
+                time.sleep(default_request_scheduler().backoff_delay(attempt))
+                attempt += 1
+
+    return map_bounded(query_window, split_cost_query(query, partition), max_concurrency)
+
+
+_WINDOW_RETRIES = 3
+
+
+def _is_transient_error(error: Exception) -> bool:
+    # Connection failures, throttling that outlasted the scheduler's retries and server errors.
+    if isinstance(error, (ClientRequestError, ThrottledError)):
+        return True
+    if isinstance(error, HttpOperationError):
+        status_code = getattr(error.response, "status_code", None)
+        return status_code is not None and (status_code >= 500 or status_code in (408, 429))
+    return False
+
+
+def _query_cost_sharded(
+    query_native: Callable[[Union[AzureBillingAccount, AzureSubscriptionHandle], QueryDefinition, int], R],
+    scope: Union[AzureBillingAccount, AzureSubscriptionHandle],
+    query: QueryDefinition,
+    max_pages: int,
+    shard_dimension: Optional[str],
+    max_concurrency: int,
+) -> List[R]:
+    try:
+        return [query_native(scope, query, max_pages)]
+    except CostQueryTooLargeError:
+        shard_dimension = _resolve_shard_dimension(scope, shard_dimension)
+        values = _query_dimension_values(scope, query, shard_dimension, max_pages)
+        if len(values) < 2:
+            raise
+
+    # Values come ordered by cost, so dealing them out round-robin spreads the large ones evenly.
+    shard_count = min(len(values), max(2, max_concurrency))
+    shards = [values[i::shard_count] for i in range(shard_count)]
+    query_shard = functools.partial(_query_cost_shard, query_native, scope, query, max_pages, shard_dimension)
+    return [result for results in map_bounded(query_shard, shards, max_concurrency) for result in results]
+
+
+def _resolve_shard_dimension(
+    scope: Union[AzureBillingAccount, AzureSubscriptionHandle], shard_dimension: Optional[str]
+) -> str:
+    if shard_dimension is not None:
+        return shard_dimension
+    return "SubscriptionId" if isinstance(scope, AzureBillingAccount) else "ResourceGroupName"
+
+
+def _is_grouped_by(query: QueryDefinition, dimension: str) -> bool:
+    return any(g.name.lower() == dimension.lower() for g in query.dataset.grouping or [])
+
+
+def _aggregate_column_names(query: QueryDefinition) -> Set[str]:
+    # Result columns are named after the aggregation or the column it aggregates, depending on the
+    # API version.
+    aggregation = query.dataset.aggregation or {}
+    return {name.lower() for key, value in aggregation.items() for name in (key, value.name)}
+
+
+def _sum_cost_rows(query: QueryDefinition, dataframe: DataFrame) -> DataFrame:
+    # Sums the aggregated columns of rows that have the same values in all other columns. Keys are
+    # grouped by their factorized codes so that null keys form groups of their own.
+    aggregates = _aggregate_column_names(query)
+    sums = [c for c in dataframe.columns if c.lower() in aggregates]
+    keys = [c for c in dataframe.columns if c.lower() not in aggregates]
+    if not keys:
+        return dataframe[sums].sum(min_count=1).to_frame().T
+    grouped = dataframe.groupby([factorize(dataframe[k])[0] for k in keys], sort=False)
+    summed = concat([grouped[keys].first(), grouped[sums].sum(min_count=1)], axis=1)
+    return summed.reset_index(drop=True)[list(dataframe.columns)]
+
+
+def _sum_query_results(query: QueryDefinition, results: List[QueryResult]) -> QueryResult:
+    aggregates = _aggregate_column_names(query)
+    sum_indices = [i for i, c in enumerate(results[0].columns) if c.name.lower() in aggregates]
+    key_indices = [i for i, c in enumerate(results[0].columns) if c.name.lower() not in aggregates]
+    merged: Dict[Tuple, list] = {}
+    for row in itertools.chain.from_iterable(r.rows for r in results):
+        key = tuple(row[i] for i in key_indices)
+        merged_row = merged.get(key)
+        if merged_row is None:
+            merged[key] = list(row)
+            continue
+        for i in sum_indices:
+            if row[i] is not None:
+                merged_row[i] = row[i] if merged_row[i] is None else merged_row[i] + row[i]
+    result = copy.copy(results[0])
+    result.rows = list(merged.values())
+    result.next_link = None
+    return result
+
+
+def _query_cost_shard(
+    query_native: Callable[[Union[AzureBillingAccount, AzureSubscriptionHandle], QueryDefinition, int], R],
+    scope: Union[AzureBillingAccount, AzureSubscriptionHandle],
+    query: QueryDefinition,
+    max_pages: int,
+    dimension: str,
+    values: Sequence[str],
+) -> List[R]:
+    shard_query = copy.copy(query)
+    shard_query.dataset = copy.copy(query.dataset)
+    shard_query.dataset.filter = add_dimension_filter(query.dataset.filter, dimension, values)
+    try:
+        return [query_native(scope, shard_query, max_pages)]
+    except CostQueryTooLargeError:
+        if len(values) == 1:
+            raise
+    half = len(values) // 2
+    first = _query_cost_shard(query_native, scope, query, max_pages, dimension, values[:half])
+    return first + _query_cost_shard(query_native, scope, query, max_pages, dimension, values[half:])
+
+
+def _query_dimension_values(
+    scope: Union[AzureBillingAccount, AzureSubscriptionHandle],
+    query: QueryDefinition,
+    dimension: str,
+    max_pages: int,
+) -> List[str]:
+    # The distinct values of dimension within the query's filter and time period, highest cost first.
+    values_query = copy.copy(query)
+    values_query.dataset = QueryDataset(
+        granularity=GranularityType.none,
+        aggregation=query.dataset.aggregation,
+        grouping=[QueryGrouping(type=QueryColumnType.dimension, name=dimension)],
+        filter=query.dataset.filter,
+    )
+    columns, buffers = _query_cost_columns(scope, values_query, max_pages)
+    names = [c.name.lower() for c in columns]
+    values = list(buffers[names.index(dimension.lower())].values)
+    cost_buffer = next((b for b in buffers if b.kusto_datatype == "real"), None)
+    if cost_buffer is not None:
+        order = sorted(range(len(values)), key=lambda i: cost_buffer.values[i], reverse=True)
+        values = [values[i] for i in order]
+    # Shard filters can only match non-empty values, so cost without a value would be lost.
+    if any(v is None or v == "" for v in values):
+        raise CostQueryTooLargeError(
+            f"Cost query is too large and some of its cost has no {dimension} to shard by."
+        )
+    return values
 
 
 def _query_cost_native(
     scope: Union[AzureBillingAccount, AzureSubscriptionHandle], query: QueryDefinition, max_pages: int
 ) -> List[QueryResult]:
     client = default_sdk_client(CostManagementClient)
-    raw_result: ClientRawResponse = client.query.usage(scope.resource_id(), query, raw=True)
+    raw_result: ClientRawResponse = scheduled_call(
+        ApiFamily.cost_management, lambda: client.query.usage(scope.resource_id(), query, raw=True)
+    )
     result = raw_result.output
     results = [result]
     next_link = result.next_link
@@ -154,9 +488,11 @@ def _query_cost_native(
         service_client = client._client
         while next_link:
             if pages == max_pages:
-                raise Exception("More results remain after max pages of cost query.")
+                raise CostQueryTooLargeError("More results remain after max pages of cost query.")
             request = service_client.post(next_link, headers=headers, content=body)
-            response = service_client.send(request, stream=False)
+            response = scheduled_call(
+                ApiFamily.cost_management, lambda: service_client.send(request, stream=False)
+            )
             if response.status_code != 200:
                 raise Exception("Failed to get next page of cost query.")
             result = client.query._deserialize('QueryResult', response)
@@ -167,6 +503,55 @@ def _query_cost_native(
     return results
 
 
+def _query_cost_columns(
+    scope: Union[AzureBillingAccount, AzureSubscriptionHandle], query: QueryDefinition, max_pages: int
+) -> Tuple[List[KustoColumnDescriptor], List[ColumnBuffer]]:
+    # Same paging as _query_cost_native, but each page's JSON is decoded straight into column
+    # buffers instead of QueryResult models. The request is built here rather than through
+    # client.query.usage because that always deserializes the response and clients are shared.
+    # The next page is fetched on a worker thread while the current one is being decoded.
+    client = default_sdk_client(CostManagementClient)
+    operations = client.query
+    service_client = client._client
+    url = service_client.format_url(operations.usage.metadata["url"], scope=scope.resource_id())
+    headers = {"Accept": "application/json", "Content-Type": "application/json; charset=utf-8"}
+    body = operations._serialize.body(query, "QueryDefinition")
+
+    def fetch_page(page_url: str, query_parameters: Optional[dict]) -> dict:
+        request = service_client.post(page_url, query_parameters, headers, body)
+        response = scheduled_call(
+            ApiFamily.cost_management, lambda: service_client.send(request, stream=False)
+        )
+        if response.status_code != 200:
+            raise ErrorResponseException(operations._deserialize, response)
+        return json.loads(response.content)["properties"]
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        page = fetch_page(url, {"api-version": operations.api_version})
+        columns = [
+            KustoColumnDescriptor(c["name"], _COST_MANAGEMENT_TO_KUSTO_TYPE_MAP[c["type"]])
+            for c in page["columns"]
+        ]
+        buffers = [ColumnBuffer(c.type) for c in columns]
+        appenders = [b.append for b in buffers]
+        pages = 1
+        while True:
+            next_link = page.get("nextLink")
+            if next_link:
+                if pages == max_pages:
+                    raise CostQueryTooLargeError("More results remain after max pages of cost query.")
+                next_page = executor.submit(fetch_page, next_link, None)
+            for row in page["rows"]:
+                for append, value in zip(appenders, row):
+                    append(value)
+            if not next_link:
+                break
+            page = next_page.result()
+            pages += 1
+
+    return columns, buffers
+
+
 def create_cost_query(
     timeframe: Union[TimeframeType, Tuple[datetime, Union[datetime, timedelta]]],
     cost_type: ExportType = ExportType.amortized_cost,
@@ -239,5 +624,20 @@ def create_basic_filter(
             )
         )
 
-    return QueryFilter(and_property=filters)
+    # An "and" needs at least two operands.
+    return QueryFilter(and_property=filters) if len(filters) > 1 else filters[0]
+
+
+def add_dimension_filter(
+    query_filter: Optional[QueryFilter], dimension: str, values: Sequence[str]
+) -> QueryFilter:
+    """Restrict query_filter (e.g. from create_basic_filter) to rows whose dimension is one of values."""
+    dimension_filter = QueryFilter(
+        dimension=QueryComparisonExpression(name=dimension, operator="In", values=list(values))
+    )
+    if query_filter is None:
+        return dimension_filter
+    if query_filter.and_property:
+        return QueryFilter(and_property=query_filter.and_property + [dimension_filter])
+    return QueryFilter(and_property=[query_filter, dimension_filter])
 
@@ -0,0 +1,120 @@
+import hashlib
+import importlib.util
+import json
+import os
+import shutil
+import threading
+import time
+import warnings
+from datetime import timedelta
+from typing import Any, List, Optional, Sequence
+from pandas import DataFrame
+
+from .config import direct
+from .utils.storage import read_dataframe, read_json, write_dataframe, write_json
+
+
+class ResultCache:
+    """On-disk cache of query results, stored as one Parquet file per result table.
+
+    Entries expire after ttl unless they were stored as immutable. When the cache grows beyond
+    max_size bytes the least recently read entries are removed first.
+    """
+
+    def __init__(self, directory: str, ttl: Optional[timedelta] = None, max_size: Optional[int] = None):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[List[DataFrame]]:
+        entry = os.path.join(self.directory, key)
+        meta_path = os.path.join(entry, 'meta.json')
+        meta = read_json(meta_path)
+        if meta is None:
+            return None
+        if meta['expires'] is not None and meta['expires'] < time.time():
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        try:
+            tables = [
+                read_dataframe(os.path.join(entry, f'table-{i}.parquet')) for i in range(meta['tables'])
+            ]
+            os.utime(meta_path)
+        except FileNotFoundError:
+            return None
+        return tables
+
+    def put(self, key: str, tables: Sequence[DataFrame], immutable: bool = False) -> None:
+        entry = os.path.join(self.directory, key)
+        os.makedirs(entry, exist_ok=True)
+        for i, table in enumerate(tables):
+            write_dataframe(os.path.join(entry, f'table-{i}.parquet'), table)
+        now = time.time()
+        expires = None if immutable or self.ttl is None else now + self.ttl.total_seconds()
+        write_json(
+            os.path.join(entry, 'meta.json'), {'tables': len(tables), 'created': now, 'expires': expires}
+        )
+        self._evict()
+
+    def clear(self) -> None:
+        with self._lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _evict(self) -> None:
+        with self._lock:
+            now = time.time()
+            entries = []
+            for name in os.listdir(self.directory):
+                entry = os.path.join(self.directory, name)
+                meta_path = os.path.join(entry, 'meta.json')
+                meta = read_json(meta_path)
+                if meta is None:
+                    continue
+                if meta['expires'] is not None and meta['expires'] < now:
+                    shutil.rmtree(entry, ignore_errors=True)
+                    continue
+                size = sum(f.stat().st_size for f in os.scandir(entry) if f.is_file())
+                entries.append((os.stat(meta_path).st_mtime, size, entry))
+
+            if self.max_size is None:
+                return
+            total_size = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total_size -= size
+
+
+def result_cache_key(kind: str, query: Any, scope: Any, timespan: Any = None, options: Any = None) -> str:
+    if isinstance(query, str):
+        query = ' '.join(query.split())
+    normalized = json.dumps([kind, query, scope, timespan, options], sort_keys=True, default=str)
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def default_result_cache(enabled: Optional[bool] = None) -> Optional[ResultCache]:
+    settings = direct()['azmeta']['cache']
+    if enabled is None:
+        enabled = settings['enabled'].get(bool)
+    if not enabled:
+        return None
+    if importlib.util.find_spec('pyarrow') is None:
+        # Checked up front so a query is not run only to fail when its result is stored.
+        warnings.warn(
+            'The result cache needs pyarrow (pip install azmeta[cache]); results will not be cached.'
+        )
+        return None
+
+    if settings['directory'].get() is None:
+        directory = os.path.join(direct().config_dir(), 'cache')
+    else:
+        directory = settings['directory'].as_filename()
+    ttl_seconds = settings['ttl_seconds'].get()
+    max_size_mb = settings['max_size_mb'].get()
+    return ResultCache(
+        os.path.join(directory, 'results'),
+        ttl=None if ttl_seconds is None else timedelta(seconds=ttl_seconds),
+        max_size=None if max_size_mb is None else max_size_mb * 1024 ** 2,
+    )
@@ -1,13 +1,38 @@
+import threading
+from typing import Optional
 
 from .interface import AzmetaResourceContext, AzmetaAuthenticationContext
 
 
 def default_resource_context() -> AzmetaResourceContext:
-    from .cli_context import AzureCliResourceContext
-    return AzureCliResourceContext()
+    global _default_resource_context
+    with _default_context_lock:
+        if _default_resource_context is None:
+            from .cli_context import AzureCliResourceContext
+            _default_resource_context = AzureCliResourceContext()
+        return _default_resource_context
 
 
 def default_authentication_context() -> AzmetaAuthenticationContext:
-    from .cli_context import AzureCliAuthenticationContext
-    return AzureCliAuthenticationContext()
+    global _default_authentication_context
+    with _default_context_lock:
+        if _default_authentication_context is None:
+            from .cli_context import AzureCliAuthenticationContext
+            _default_authentication_context = AzureCliAuthenticationContext()
+        return _default_authentication_context
+
+
+def invalidate_default_contexts() -> None:
+    """Forget the process-wide contexts, e.g. after 'az login' or 'az account set'."""
+    global _default_resource_context, _default_authentication_context
+    from ..utils.sdk import clear_sdk_client_pool
+    with _default_context_lock:
+        _default_resource_context = None
+        _default_authentication_context = None
+    clear_sdk_client_pool()
+
+
+_default_context_lock = threading.Lock()
+_default_resource_context: Optional[AzmetaResourceContext] = None
+_default_authentication_context: Optional[AzmetaAuthenticationContext] = None
 
@@ -1,8 +1,9 @@
+import configparser
 import json
 import os
 import subprocess
 from functools import cached_property
-from typing import List, Union, Sequence
+from typing import List, Optional, Union, Sequence
 
 from azure.core.credentials import AccessToken
 from azure.identity import AzureCliCredential
@@ -12,6 +13,7 @@ from azmeta.access import AzureSubscriptionHandle, AzureBillingAccount
 from azmeta.access.billing import get_billing_accounts
 from azmeta.access.config import direct
 from azmeta.access.context.interface import AzmetaResourceContext, AzmetaAuthenticationContext
+from azmeta.access.context.token_cache import AccessTokenCache
 
 
 class AzureCliResourceContext(AzmetaResourceContext):
@@ -24,7 +26,9 @@ class AzureCliResourceContext(AzmetaResourceContext):
 
     @cached_property
     def subscriptions(self) -> List[AzureSubscriptionHandle]:
-        json_data = json.loads(_run_command("az account list"))
+        json_data = _read_profile_subscriptions()
+        if json_data is None:
+            json_data = json.loads(_run_command("az account list"))
         all_subscriptions = [
             AzureSubscriptionHandle(s["id"], s["name"], s["tenantId"], s["isDefault"]) for s in json_data
         ]
@@ -45,6 +49,27 @@ class AzureCliResourceContext(AzmetaResourceContext):
             raise Exception("Multiple billing accounts detected. Set default account in the azmeta config.")
 
 
+def _read_profile_subscriptions() -> Optional[List[dict]]:
+    # Reads the subscriptions 'az account list' would return straight from the CLI profile.
+    # Returns None when the profile is missing or unusable so the caller can fall back to the CLI.
+    config_dir = os.environ.get("AZURE_CONFIG_DIR", os.path.expanduser(os.path.join("~", ".azure")))
+    try:
+        with open(os.path.join(config_dir, "azureProfile.json"), encoding="utf-8-sig") as file:
+            subscriptions = json.load(file)["subscriptions"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+    cli_config = configparser.ConfigParser()
+    cli_config.read(os.path.join(config_dir, "config"))
+    cloud_name = cli_config.get("cloud", "name", fallback="AzureCloud")
+    subscriptions = [
+        s for s in subscriptions if s.get("environmentName") == cloud_name and s.get("state") == "Enabled"
+    ]
+    if not any(s.get("isDefault") for s in subscriptions):
+        return None
+    return subscriptions
+
+
 CLI_NOT_FOUND = "Azure CLI not found on path"
 NOT_LOGGED_IN = "Please run 'az login' to set up an account"
 
@@ -75,8 +100,25 @@ def _run_command(command):
 
 
 class AzureCliAuthenticationContext(AzmetaAuthenticationContext):
-    def __init__(self):
+    def __init__(self, token_cache: Optional[AccessTokenCache] = None):
         self._credential = AzureCliCredential()
+        self._token_cache = token_cache if token_cache is not None else _default_token_cache()
 
-    def get_token(self, scopes: Union[Sequence[str], str]) -> AccessToken:
-        return self._credential.get_token(scopes)
+    def get_token(self, scopes: Union[Sequence[str], str], *, tenant_id: Optional[str] = None) -> AccessToken:
+        if isinstance(scopes, str):
+            scopes = [scopes]
+        kwargs = {} if tenant_id is None else {"tenant_id": tenant_id}
+        return self._token_cache.get_token(
+            lambda: self._credential.get_token(*scopes, **kwargs), scopes, tenant_id
+        )
+
+
+def _default_token_cache() -> AccessTokenCache:
+    settings = direct()["azmeta"]["token_cache"]
+    path = None
+    if settings["persist"].get(bool):
+        if settings["path"].get() is None:
+            path = os.path.join(direct().config_dir(), "token_cache.json")
+        else:
+            path = settings["path"].as_filename()
+    return AccessTokenCache(path, refresh_margin=settings["refresh_margin_seconds"].get(int))
@@ -1,5 +1,5 @@
 from abc import ABCMeta, abstractmethod
-from typing import List, Union, Sequence
+from typing import List, Optional, Union, Sequence
 from azmeta.access import AzureSubscriptionHandle, AzureBillingAccount
 from azure.core.credentials import AccessToken
 
@@ -22,5 +22,5 @@ class AzmetaResourceContext(metaclass=ABCMeta):
 
 class AzmetaAuthenticationContext(metaclass=ABCMeta):
     @abstractmethod
-    def get_token(self, scopes: Union[Sequence[str],str]) -> AccessToken:
+    def get_token(self, scopes: Union[Sequence[str],str], *, tenant_id: Optional[str] = None) -> AccessToken:
         pass
@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from azure.core.credentials import AccessToken
+
+
+_TokenKey = Tuple[Tuple[str, ...], Optional[str]]
+
+
+class AccessTokenCache:
+    """Thread-safe cache of access tokens keyed by scopes and tenant.
+
+    Tokens are refreshed refresh_margin seconds before they expire. When path is set, valid
+    tokens are also saved to that file (readable only by the current user) so later processes
+    can reuse them.
+    """
+
+    def __init__(self, path: Optional[str] = None, refresh_margin: int = 300):
+        self._path = path
+        self._refresh_margin = refresh_margin
+        self._tokens: Dict[_TokenKey, AccessToken] = {}
+        self._lock = threading.Lock()
+        self._key_locks: Dict[_TokenKey, threading.Lock] = {}
+        if path is not None:
+            self._load()
+
+    def get_token(
+        self, acquire: Callable[[], AccessToken], scopes: Sequence[str], tenant_id: Optional[str] = None
+    ) -> AccessToken:
+        key = (tuple(scopes), tenant_id)
+        token = self._valid_token(key)
+        if token is not None:
+            return token
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # Another thread may have acquired the token while this one waited.
+            token = self._valid_token(key)
+            if token is not None:
+                return token
+            token = acquire()
+            with self._lock:
+                self._tokens[key] = token
+                if self._path is not None:
+                    self._save()
+            return token
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tokens.clear()
+            if self._path is not None:
+                self._save()
+
+    def _valid_token(self, key: _TokenKey) -> Optional[AccessToken]:
+        with self._lock:
+            token = self._tokens.get(key)
+        if token is not None and token.expires_on - self._refresh_margin > time.time():
+            return token
+        return None
+
+    def _load(self) -> None:
+        try:
+            with open(self._path) as file:  # type: ignore
+                entries = json.load(file)
+        except (FileNotFoundError, ValueError):
+            return
+        now = time.time()
+        for entry in entries:
+            token = AccessToken(entry["token"], entry["expires_on"])
+            if token.expires_on > now:
+                self._tokens[(tuple(entry["scopes"]), entry["tenant_id"])] = token
+
+    def _save(self) -> None:
+        now = time.time()
+        entries = [
+            {
+                "scopes": list(scopes),
+                "tenant_id": tenant_id,
+                "token": token.token,
+                "expires_on": token.expires_on,
+            }
+            for (scopes, tenant_id), token in self._tokens.items()
+            if token.expires_on > now
+        ]
+        path: str = self._path  # type: ignore
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as file:
+            json.dump(entries, file)
+        os.replace(temp_path, path)
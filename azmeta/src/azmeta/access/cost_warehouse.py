@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+from typing import Any, Callable, List, Optional, Sequence, Tuple, Union
+from azure.mgmt.billing.models import BillingPeriod
+from azure.mgmt.costmanagement.models import QueryDefinition
+from pandas import DataFrame, concat
+
+from ._core import AzureBillingAccount, AzureSubscriptionHandle
+from .billing import (
+    CostTimePartition,
+    billing_period_to_full_day_timespan,
+    get_billing_periods,
+    is_billing_period_closed,
+    query_cost_dataframe,
+)
+from .config import direct
+from .utils.concurrency import imap_bounded
+from .utils.storage import read_dataframe, read_json, write_dataframe, write_json
+
+Scope = Union[AzureBillingAccount, AzureSubscriptionHandle]
+
+
+class CostWarehouse:
+    """Local Parquet store of cost query results, partitioned by dataset, scope and billing period.
+
+    sync fetches each billing period once it is closed and never again; the open period and periods
+    still inside the late-arrival window are fetched again on every sync. read loads partitions
+    with column and row filter pushdown.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def sync(
+        self,
+        scope: Scope,
+        dataset: str,
+        build_query: Callable[[Tuple[datetime, datetime]], QueryDefinition],
+        periods: Optional[Sequence[BillingPeriod]] = None,
+        max_concurrency: int = 1,
+        partition: Optional[CostTimePartition] = None,
+    ) -> List[str]:
+        """Bring dataset up to date for scope and return the names of the periods that were fetched.
+
+        build_query makes the cost query for a billing period's full-day timespan. It must build the
+        same query for every period; a dataset synced with a different query raises ValueError.
+        periods defaults to the last 12 billing periods.
+        """
+        if periods is None:
+            periods = get_billing_periods(limit=12)
+        directory = self._scope_directory(dataset, scope)
+        os.makedirs(directory, exist_ok=True)
+
+        fingerprint = _query_fingerprint(build_query(billing_period_to_full_day_timespan(periods[0])))
+        manifest_path = os.path.join(directory, 'manifest.json')
+        manifest = read_json(manifest_path) or {'fingerprint': fingerprint, 'periods': {}}
+        if manifest['fingerprint'] != fingerprint:
+            raise ValueError(f'Dataset {dataset} was synced with a different query.')
+
+        stale = [p for p in periods if not manifest['periods'].get(p.name, {}).get('closed', False)]
+
+        def fetch(period: BillingPeriod) -> dict:
+            closed = is_billing_period_closed(period)
+            query = build_query(billing_period_to_full_day_timespan(period))
+            dataframe = query_cost_dataframe(scope, query, cache=False, partition=partition)
+            dataframe['BillingPeriod'] = period.name
+            write_dataframe(os.path.join(directory, f'{period.name}.parquet'), dataframe)
+            return {'closed': closed, 'synced': time.time(), 'rows': len(dataframe)}
+
+        # The manifest is rewritten as each period is stored, so a failed sync only repeats the
+        # periods that were not stored.
+        for period, entry in zip(stale, imap_bounded(fetch, stale, max_concurrency)):
+            manifest['periods'][period.name] = entry
+            write_json(manifest_path, manifest)
+        return [p.name for p in stale]
+
+    def read(
+        self,
+        scope: Scope,
+        dataset: str,
+        periods: Optional[Sequence[str]] = None,
+        columns: Optional[Sequence[str]] = None,
+        filters: Optional[List[Any]] = None,
+    ) -> DataFrame:
+        """Load synced billing periods (all when periods is None), reading only columns and the row
+        groups that can match filters (pyarrow filter syntax)."""
+        directory = self._scope_directory(dataset, scope)
+        manifest = read_json(os.path.join(directory, 'manifest.json'))
+        if manifest is None:
+            raise ValueError(f'Dataset {dataset} has not been synced for {scope.resource_id()}.')
+        names = (
+            sorted(manifest['periods'])
+            if periods is None
+            else [p for p in periods if p in manifest['periods']]
+        )
+        dataframes = [
+            read_dataframe(os.path.join(directory, f'{name}.parquet'), columns=columns, filters=filters)
+            for name in names
+        ]
+        if not dataframes:
+            return DataFrame(columns=columns)
+        return concat(dataframes, ignore_index=True)
+
+    def _scope_directory(self, dataset: str, scope: Scope) -> str:
+        scope_key = hashlib.sha256(scope.resource_id().lower().encode()).hexdigest()[:16]
+        return os.path.join(self.directory, dataset, scope_key)
+
+
+def default_cost_warehouse() -> CostWarehouse:
+    settings = direct()['azmeta']['cost_warehouse']
+    if settings['directory'].get() is None:
+        directory = os.path.join(direct().config_dir(), 'cost_warehouse')
+    else:
+        directory = settings['directory'].as_filename()
+    return CostWarehouse(directory)
+
+
+def _query_fingerprint(query: QueryDefinition) -> str:
+    serialized = query.serialize()
+    serialized.pop('timePeriod', None)
+    return hashlib.sha256(json.dumps(serialized, sort_keys=True, default=str).encode()).hexdigest()
@@ -1,3 +1,13 @@
-from ._serialize import serialize_to_kql
+from ._serialize import serialize_to_kql, serialize_dataframe_to_kql_literals
 from ._response import KustoDataFrameResponse, dataframe_response_from_kusto_response
-from ._deserialize import KustoColumnDescriptor, kusto_data_to_dataframe
\ No newline at end of file
+from ._buffer import ColumnBuffer
+from ._deserialize import (
+    KustoColumnDescriptor,
+    KustoDecodeOptions,
+    KustoDynamicPath,
+    kusto_data_to_dataframe,
+    kusto_columns_to_dataframe,
+    kusto_datetime_series,
+    kusto_timespan_series,
+    parse_dynamic_series,
+)
\ No newline at end of file
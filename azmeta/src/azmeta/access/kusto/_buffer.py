@@ -0,0 +1,63 @@
+from array import array
+from typing import Any, Callable, Dict, List, Optional, Union
+
+
+class ColumnBuffer:
+    """Append-only storage for the values of one column.
+
+    bool, int, long and real values are packed into an array with a separate null mask, so a
+    decoded cell costs a few bytes instead of a Python object. Other types are kept in a list,
+    with repeated strings interned so each distinct string is kept only once.
+    """
+
+    __slots__ = ('kusto_datatype', 'values', 'nulls', '_convert', '_interned')
+
+    def __init__(self, kusto_datatype: str):
+        self.kusto_datatype = kusto_datatype
+        packing = _packed_types.get(kusto_datatype)
+        self.values: Union[array, List[Any]]
+        self.nulls: Optional[bytearray]
+        self._convert: Optional[Callable[[Any], Any]]
+        self._interned: Optional[Dict[str, str]] = {} if kusto_datatype in _interned_types else None
+        if packing:
+            typecode, self._convert = packing
+            self.values = array(typecode)
+            self.nulls = bytearray()
+        else:
+            self._convert = None
+            self.values = []
+            self.nulls = None
+
+    @property
+    def is_packed(self) -> bool:
+        return self.nulls is not None
+
+    def append(self, value: Any) -> None:
+        if self.nulls is None:
+            if self._interned is not None and value is not None:
+                value = self._interned.setdefault(value, value)
+            self.values.append(value)
+        elif value is None:
+            self.values.append(0)
+            self.nulls.append(1)
+        else:
+            self.values.append(self._convert(value))  # type: ignore
+            self.nulls.append(0)
+
+    def extend(self, other: 'ColumnBuffer') -> None:
+        self.values.extend(other.values)  # type: ignore
+        if self.nulls is not None:
+            self.nulls.extend(other.nulls)  # type: ignore
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+_packed_types = {
+    'bool': ('b', bool),
+    'int': ('q', int),
+    'long': ('q', int),
+    'real': ('d', float),
+}
+
+_interned_types = {'string', 'guid', 'datetime', 'timespan'}
@@ -1,6 +1,11 @@
-from typing import NamedTuple, List, Any, Iterable, Union, Sequence
-from pandas import DataFrame, Series
+from typing import NamedTuple, List, Any, Dict, Iterable, Optional, Union, Sequence
+from pandas import Categorical, DataFrame, Series, factorize, to_datetime
+from pandas.arrays import BooleanArray, IntegerArray
 from ..utils.types import realize_sequence
+from ._buffer import ColumnBuffer
+import itertools
+import numpy
+import pandas
 import json
 
 class KustoColumnDescriptor(NamedTuple):
@@ -8,20 +13,235 @@ class KustoColumnDescriptor(NamedTuple):
     type: str
 
 
-def kusto_data_to_dataframe(columns: Sequence[KustoColumnDescriptor], rows: Iterable[Sequence[Any]]) -> DataFrame:
-    rows = realize_sequence(rows)
-    series = {name: _make_series((x[index] for x in rows), kdtype) for index, (name, kdtype) in enumerate(columns)}
+class KustoDynamicPath(NamedTuple):
+    column: str
+    # Dot separated keys, with integer keys indexing into arrays, e.g. 'sku.name' or
+    # 'ipConfigurations.0.id'.
+    path: str
+    type: str = 'string'
+    name: Optional[str] = None  # Defaults to '<column>.<path>'.
+
+
+class KustoDecodeOptions(NamedTuple):
+    # Decode datetime and timespan as strings instead of datetime64[ns, UTC] and timedelta64[ns].
+    temporal_as_string: bool = False
+    # Leave JSON text in dynamic columns unparsed; parse it when needed with parse_dynamic_series.
+    lazy_dynamic: bool = False
+    # Values to extract from dynamic columns into typed columns of their own.
+    dynamic_paths: Sequence[KustoDynamicPath] = ()
+    # Columns to decode as category.
+    categorical_columns: Sequence[str] = ()
+    # Also decode string columns as category when their distinct values are at most this fraction of the rows.
+    categorical_threshold: Optional[float] = None
+
+
+def kusto_data_to_dataframe(
+    columns: Sequence[KustoColumnDescriptor],
+    rows: Iterable[Sequence[Any]],
+    options: Optional[KustoDecodeOptions] = None,
+) -> DataFrame:
+    # Transpose in a single pass over the rows, a block at a time: zip(*block) unpacks each row in C
+    # and the block size bounds the temporary tuples it builds.
+    column_data: List[List[Any]] = [[] for _ in columns]
+    rows = iter(rows)
+    while True:
+        block = list(itertools.islice(rows, _TRANSPOSE_BLOCK_ROWS))
+        if not block:
+            break
+        for values, block_values in zip(column_data, zip(*block)):
+            values.extend(block_values)
+    return kusto_columns_to_dataframe(columns, column_data, options)
+
+
+_TRANSPOSE_BLOCK_ROWS = 4096
+
+
+def kusto_columns_to_dataframe(
+    columns: Sequence[KustoColumnDescriptor],
+    column_data: Sequence[Union[ColumnBuffer, Iterable[Any]]],
+    options: Optional[KustoDecodeOptions] = None,
+) -> DataFrame:
+    options = options or KustoDecodeOptions()
+    series = {}
+    for (name, kdtype), data in zip(columns, column_data):
+        if kdtype != 'dynamic':
+            series[name] = _make_column_series(name, data, kdtype, options)
+            continue
+        values = realize_sequence(data.values if isinstance(data, ColumnBuffer) else data)
+        paths = [p for p in options.dynamic_paths if p.column == name]
+        parsed = _parse_distinct_text(values) if paths or not options.lazy_dynamic else {}
+        series[name] = Series(
+            values if options.lazy_dynamic else _substitute_parsed(values, parsed), dtype='object'
+        )
+        if paths:
+            for path, path_values in zip(paths, _extract_dynamic_paths(values, parsed, paths)):
+                series[path.name or f'{name}.{path.path}'] = _make_series(path_values, path.type, options)
     return DataFrame(series)
 
 
-def _make_series(data: Iterable[Any], kusto_datatype: str) -> Series:
+def parse_dynamic_series(series: Series) -> Series:
+    """Parse the JSON text in a dynamic column decoded with lazy_dynamic."""
+    values = series.tolist()
+    return Series(
+        _substitute_parsed(values, _parse_distinct_text(values)),
+        index=series.index,
+        name=series.name,
+        dtype='object',
+    )
+
+
+def kusto_datetime_series(values: Iterable[Any]) -> Series:
+    """Parse ISO 8601 datetimes (Kusto and Cost Management formats) into datetime64[ns, UTC]."""
+    series = Series(realize_sequence(values), dtype=object)
+    # Kusto trims trailing fractional zeros, so a column mixes ...:00Z and ...:00.1234567Z. numpy
+    # parses each value on its own, where to_datetime infers one format from the first value.
+    text = series.str.rstrip('Z').to_numpy(dtype=object, na_value=None)
+    try:
+        return Series(numpy.array(text, dtype='datetime64[ns]')).dt.tz_localize('UTC')
+    except ValueError:
+        return Series(to_datetime(series, utc=True, **_ISO8601_FORMAT))
+
+
+# pandas 2 infers a single format per column unless told the values are ISO 8601.
+_ISO8601_FORMAT = {'format': 'ISO8601'} if int(pandas.__version__.split('.')[0]) >= 2 else {}
+
+
+def kusto_timespan_series(values: Iterable[Any]) -> Series:
+    """Parse Kusto timespans ([-][d.]hh:mm:ss[.fffffff]) into timedelta64[ns]."""
+    # Timespans repeat heavily (bins, durations), so only the distinct values are parsed.
+    codes, uniques = factorize(Series(realize_sequence(values), dtype=object))
+    text = Series(uniques, dtype=object)
+    parts = text.str.extract(_timespan_pattern)
+    if parts['seconds'].isna().any():
+        raise ValueError(f'invalid timespan: {text[parts["seconds"].isna()].iloc[0]}')
+
+    parts = parts.fillna({'sign': '', 'days': '0', 'fraction': ''})
+    seconds = (
+        (parts['days'].astype('int64') * 24 + parts['hours'].astype('int64')) * 60
+        + parts['minutes'].astype('int64')
+    ) * 60 + parts['seconds'].astype('int64')
+    nanoseconds = seconds * 10 ** 9 + parts['fraction'].str.slice(0, 9).str.ljust(9, '0').astype('int64')
+    nanoseconds = nanoseconds.where(parts['sign'] != '-', -nanoseconds)
+    result = numpy.append(nanoseconds.to_numpy(), 0)[codes].astype('timedelta64[ns]')
+    result[codes == -1] = numpy.timedelta64('NaT')
+    return Series(result)
+
+
+def _make_column_series(
+    name: str, data: Union[ColumnBuffer, Iterable[Any]], kusto_datatype: str, options: KustoDecodeOptions
+) -> Series:
+    chosen = name in options.categorical_columns
+    if _kusto_datatype_map[kusto_datatype] == 'string' and (
+        options.temporal_as_string or kusto_datatype not in ('datetime', 'timespan')
+    ):
+        if chosen or options.categorical_threshold is not None:
+            # Factorize the raw strings so a categorical column never builds a string array first.
+            data = realize_sequence(data.values if isinstance(data, ColumnBuffer) else data)
+            codes, uniques = factorize(numpy.array(data, dtype=object))
+            if chosen or len(uniques) <= options.categorical_threshold * len(data):  # type: ignore
+                return Series(Categorical.from_codes(codes, uniques))
+    series = _make_series(data, kusto_datatype, options)
+    return series.astype('category') if chosen else series
+
+
+def _make_series(
+    data: Union[ColumnBuffer, Iterable[Any]], kusto_datatype: str, options: KustoDecodeOptions
+) -> Series:
     dtype = _kusto_datatype_map[kusto_datatype]
+    if isinstance(data, ColumnBuffer):
+        if data.is_packed:
+            values = numpy.array(data.values)
+            mask = numpy.frombuffer(data.nulls, dtype=numpy.bool_).copy()  # type: ignore
+            return _make_masked_series(values, mask, dtype)
+        data = data.values
+
+    if dtype in _numpy_dtypes:
+        return _make_numeric_series(realize_sequence(data), dtype)
+
+    if kusto_datatype == 'datetime' and not options.temporal_as_string:
+        return kusto_datetime_series(data)
+    if kusto_datatype == 'timespan' and not options.temporal_as_string:
+        return kusto_timespan_series(data)
+
     if kusto_datatype == 'dynamic':
-        data = (_parse_dynamic(v) if isinstance(v, str) else v for v in data)
+        data = realize_sequence(data)
+        return Series(_substitute_parsed(data, _parse_distinct_text(data)), dtype=dtype)
 
     return Series(data, dtype=dtype)
 
 
+def _make_numeric_series(values: Sequence[Any], dtype: str) -> Series:
+    numpy_dtype = _numpy_dtypes[dtype]
+    if None not in values:
+        # Fast path for columns without nulls: convert straight to the numpy dtype.
+        array = numpy.array(values, dtype=numpy_dtype)
+        return _make_masked_series(array, numpy.zeros(len(array), dtype=numpy.bool_), dtype)
+
+    objects = numpy.array(values, dtype=object)
+    mask = objects == None  # noqa: E711 (elementwise comparison)
+    objects[mask] = 0
+    return _make_masked_series(objects.astype(numpy_dtype), mask, dtype)
+
+
+def _make_masked_series(values: numpy.ndarray, mask: numpy.ndarray, dtype: str) -> Series:
+    if dtype == 'float64':
+        values[mask] = numpy.nan
+        return Series(values, dtype=dtype)
+    if dtype == 'boolean':
+        return Series(BooleanArray(values.astype(numpy.bool_), mask))
+    return Series(IntegerArray(values.astype(dtype.lower()), mask))
+
+
+def _parse_distinct_text(values: Sequence[Any]) -> Dict[str, Any]:
+    # Identical payloads (tags, SKUs, settings) are common, so each distinct text is parsed once
+    # and the cells share the parsed object.
+    return {text: _parse_dynamic(text) for text in set(v for v in values if isinstance(v, str))}
+
+
+def _substitute_parsed(values: Sequence[Any], parsed: Dict[str, Any]) -> List[Any]:
+    return [parsed[v] if isinstance(v, str) else v for v in values]
+
+
+def _extract_dynamic_paths(
+    values: Sequence[Any], parsed: Dict[str, Any], paths: Sequence[KustoDynamicPath]
+) -> List[List[Any]]:
+    # Paths are looked up once per distinct payload and then gathered for every cell by code.
+    distinct: List[Any] = [None, *parsed.values()]
+    codes_of: Dict[Optional[str], int] = {text: code for code, text in enumerate(parsed, start=1)}
+    codes_of[None] = 0
+
+    def code(value: Any) -> int:
+        if value is None or isinstance(value, str):
+            return codes_of[value]
+        distinct.append(value)
+        return len(distinct) - 1
+
+    codes = numpy.fromiter((code(v) for v in values), dtype=numpy.intp, count=len(values))
+    columns = []
+    for path in paths:
+        keys = _split_path(path.path)
+        column = numpy.empty(len(distinct), dtype=object)
+        for index, value in enumerate(distinct):
+            column[index] = _get_path(value, keys)
+        columns.append(column[codes].tolist())
+    return columns
+
+
+def _split_path(path: str) -> List[Union[str, int]]:
+    return [int(key) if key.isdigit() else key for key in path.split('.')]
+
+
+def _get_path(value: Any, keys: Sequence[Union[str, int]]) -> Any:
+    for key in keys:
+        if isinstance(value, str):
+            return None
+        try:
+            value = value[key]
+        except (KeyError, IndexError, TypeError):
+            return None
+    return value
+
+
 def _parse_dynamic(value: str) -> Any:
     try:
         return json.loads(value)
@@ -29,6 +249,18 @@ def _parse_dynamic(value: str) -> Any:
         return value
 
 
+_timespan_pattern = (
+    r'^(?P<sign>-)?(?:(?P<days>\d+)\.)?'
+    r'(?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d+)(?:\.(?P<fraction>\d+))?$'
+)
+
+_numpy_dtypes = {
+    'boolean': numpy.bool_,
+    'Int32': numpy.int32,
+    'Int64': numpy.int64,
+    'float64': numpy.float64,
+}
+
 _kusto_datatype_map = {
     'bool': 'boolean',
     'datetime': 'string',
@@ -1,7 +1,10 @@
 from datetime import date, datetime
 import json
-from pandas import DataFrame
-from typing import Any
+import re
+import numpy
+from pandas import CategoricalDtype, DataFrame, Series
+from pandas.api.types import infer_dtype
+from typing import Any, List, Sequence
 
 def serialize_to_kql(value: Any) -> str:
     if value is None:
@@ -24,73 +27,142 @@ def serialize_to_kql(value: Any) -> str:
 
 # DataFrames
 
+def serialize_dataframe_to_kql_literals(value: DataFrame, max_length: int = 65536) -> List[str]:
+    """Serialize a DataFrame to datatable literals of at most max_length characters each.
+
+    Rows are never split across literals, so a single row longer than max_length still gets a
+    literal of its own. Combine the literals in a query with union.
+    """
+    header = f"datatable ({_datatable_schema(value)}) ["
+    rows = _format_rows(value)
+    budget = max_length - len(header) - 1
+    literals = []
+    start = 0
+    length = 0
+    for index, row in enumerate(rows):
+        row_length = len(row) + 2
+        if index > start and length + row_length > budget:
+            literals.append(_datatable(header, rows[start:index]))
+            start = index
+            length = 0
+        length += row_length
+    if start < len(rows) or not literals:
+        literals.append(_datatable(header, rows[start:]))
+    return literals
+
+
 def _serialize_dataframe_to_kql(value: DataFrame) -> str:
-    pass
-
-
-# def _datatable(self, df: DataFrame) -> str:
-#     t = {col: str(t).split(".")[-1].split("[",1)[0] for col, t in dict(df.dtypes).items()}
-#     d = df.to_dict("split")
-#     c = d["columns"]
-#     r = d["data"]
-#     pairs_t = {col: [str(t[col]), _DATAFRAME_TO_KQL_TYPES.get(str(t[col]))] for col in c}
-#     schema = ", ".join([f"{col}:{pairs_t[col][1]}" for col in c])
-#     data = ", ".join([", ".join([_dataframe_to_kql_value(val, pairs_t[c[idx]]) for idx, val in enumerate(row)]) for row in r])
-#     return f"datatable ({schema}) [{data}]"
-
-
-# _DATAFRAME_TO_KQL_TYPES = {
-#     "int8": "long",
-#     "int16": "long",
-#     "int32": "long",
-#     "int64": "long",
-#     "uint8": "long",
-#     "uint16": "long",
-#     "uint32": "long",
-#     "uint64": "long",
-#     "float16": "real",
-#     "float32": "real",
-#     "float64": "real",
-#     "complex64": "dynamic",
-#     "complex128": "dynamic",
-#     "character": "string",
-#     "bytes": "string",
-#     "str": "string",
-#     "void": "string",
-#     "record": "dynamic",
-#     "bool": "bool",
-#     "datetime": "datetime",
-#     "datetime64": "datetime",
-#     "object": None,
-#     "category": "string",
-#     "timedelta": "timespan",
-#     "timedelta64": "timespan",
-# }
-
-
-# def _dataframe_to_kql_value(val, pair_type:list) -> str:
-#     pd_type, kql_type = pair_type
-#     s = str(val)
-#     if kql_type == "string":
-#         if pd_type == "bytes":
-#             s = val.decode("utf-8")
-#         return "" if s is None else f"'{s}'"
-#     if kql_type == "long": 
-#         return 'long(null)' if s == 'nan' else f"long({s})"
-#     if kql_type == "real": 
-#         return 'real(null)' if s == 'nan' else f"real({s})"
-#     if kql_type == "bool": 
-#         return 'true' if val == True else 'false' if  val == False else 'bool(null)'
-#     if kql_type == "datetime":
-#         return 'datetime(null)' if s == "NaT" else f"datetime({s})" # assume utc
-#     if kql_type == "timespan":
-#         raise ValueError("can't convert timespan")
-#     if kql_type == "dynamic":
-#         if pd_type == "record":
-#             return serialize_to_kql(list(val))
-#         elif pd_type in ["complex64", "complex128"]:
-#             return serialize_to_kql([val.real, val.imag])
-#         else:
-#             return serialize_to_kql(val)
-        
-#     return "" if s is None else repr(s)
+    return _datatable(f"datatable ({_datatable_schema(value)}) [", _format_rows(value))
+
+
+def _datatable(header: str, rows: Sequence[str]) -> str:
+    return header + ", ".join(rows) + "]"
+
+
+def _datatable_schema(df: DataFrame) -> str:
+    return ", ".join(f"{_kql_column_name(str(name))}:{_kql_type(df[name])}" for name in df.columns)
+
+
+def _kql_column_name(name: str) -> str:
+    if re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name):
+        return name
+    return f"[{_quote_string(name)}]"
+
+
+def _kql_type(series: Series) -> str:
+    dtype_name = str(series.dtype).split("[", 1)[0].lower()
+    kql_type = _DATAFRAME_TO_KQL_TYPES.get(dtype_name, "dynamic")
+    if kql_type is None:
+        kql_type = "string" if infer_dtype(series, skipna=True) in ("string", "empty") else "dynamic"
+    return kql_type
+
+
+def _format_rows(df: DataFrame) -> List[str]:
+    if len(df.columns) == 0:
+        return []
+    columns = [_format_column(df[name]) for name in df.columns]
+    rows = columns[0]
+    for column in columns[1:]:
+        rows = rows + ", " + column
+    return rows.tolist()
+
+
+def _format_column(series: Series) -> numpy.ndarray:
+    # Every cell is formatted as a KQL literal, with one vectorized step per dtype.
+    kql_type = _kql_type(series)
+    if isinstance(series.dtype, CategoricalDtype):
+        categories = _format_column(Series(series.cat.categories.astype(str), dtype=object))
+        return numpy.append(categories, "''")[series.cat.codes.to_numpy()]
+
+    nulls = series.isna().to_numpy()
+    if kql_type == "string":
+        # KQL strings have no null, so missing values become empty strings.
+        text = series.astype(object).where(~nulls, "").astype(str)
+        return ("'" + text.str.translate(_STRING_ESCAPES) + "'").to_numpy(dtype=object)
+
+    if kql_type == "long":
+        formatted = series.to_numpy(dtype="int64", na_value=0).astype(str).astype(object)
+    elif kql_type == "real":
+        values = series.to_numpy(dtype="float64", na_value=numpy.nan)
+        formatted = values.astype(str).astype(object)
+        formatted[numpy.isposinf(values)] = "real(+inf)"
+        formatted[numpy.isneginf(values)] = "real(-inf)"
+    elif kql_type == "bool":
+        formatted = numpy.where(series.to_numpy(dtype=bool, na_value=False), "true", "false").astype(object)
+    elif kql_type == "datetime":
+        if series.dt.tz is not None:
+            series = series.dt.tz_convert("UTC").dt.tz_localize(None)
+        # Naive datetimes are assumed to be UTC. Nanosecond ISO strings are cut to the 100ns
+        # precision of KQL datetimes.
+        iso = numpy.datetime_as_string(series.to_numpy(dtype="datetime64[ns]"), unit="ns").astype("<U27")
+        formatted = "datetime(" + iso.astype(object) + "Z)"
+    elif kql_type == "timespan":
+        ticks = series.to_numpy(dtype="timedelta64[ns]").view("int64") // 100
+        formatted = ticks.astype(str).astype(object) + "tick"
+    else:
+        formatted = numpy.array([_format_dynamic(v) for v in series.astype(object)], dtype=object)
+    formatted[nulls] = f"{kql_type}(null)"
+    return formatted
+
+
+def _format_dynamic(value: Any) -> str:
+    if isinstance(value, complex):
+        value = [value.real, value.imag]
+    elif isinstance(value, tuple):
+        value = list(value)
+    return f"dynamic({json.dumps(value, default=str)})"
+
+
+def _quote_string(value: str) -> str:
+    return "'" + value.translate(_STRING_ESCAPES) + "'"
+
+
+_STRING_ESCAPES = str.maketrans({"\\": "\\\\", "'": "\\'", "\n": "\\n", "\r": "\\r", "\t": "\\t"})
+
+# None means the type is inferred from the values: string when they are all strings, else dynamic.
+_DATAFRAME_TO_KQL_TYPES = {
+    "int8": "long",
+    "int16": "long",
+    "int32": "long",
+    "int64": "long",
+    "uint8": "long",
+    "uint16": "long",
+    "uint32": "long",
+    "uint64": "long",
+    "float16": "real",
+    "float32": "real",
+    "float64": "real",
+    "complex64": "dynamic",
+    "complex128": "dynamic",
+    "bytes": "string",
+    "str": "string",
+    "string": "string",
+    "bool": "bool",
+    "boolean": "bool",
+    "datetime": "datetime",
+    "datetime64": "datetime",
+    "object": None,
+    "category": "string",
+    "timedelta": "timespan",
+    "timedelta64": "timespan",
+}
@@ -1,21 +1,39 @@
-from typing import NamedTuple, List, Any, Iterable, Union, Optional, Callable
-from pandas import DataFrame
+from typing import NamedTuple, List, Any, Iterable, Iterator, Union, Optional, Sequence, Tuple, Callable, Dict
+from pandas import DataFrame, Timestamp, concat
 from azmeta.access.utils.sdk import default_sdk_client
 from azure.loganalytics import LogAnalyticsDataClient
 from azure.loganalytics.models import QueryBody
 from msrest.pipeline import ClientRawResponse
-from msrest.exceptions import ClientRequestError
+from msrest.exceptions import ClientRequestError, HttpOperationError
 from requests.exceptions import Timeout
 from azure.kusto.data.response import KustoResponseDataSetV1, KustoResponseDataSet, WellKnownDataSet
+from datetime import datetime, timedelta, timezone
+import functools
 import textwrap 
 import itertools
 import json
-import functools
 import logging
+import os
+import re
+import shutil
+import threading
 import time
 from .kusto import serialize_to_kql
-from .kusto import KustoDataFrameResponse, KustoColumnDescriptor, kusto_data_to_dataframe
-from .utils.chunking import GroupedChunkList
+from .kusto import (
+    KustoDataFrameResponse,
+    KustoColumnDescriptor,
+    KustoDecodeOptions,
+    ColumnBuffer,
+    kusto_data_to_dataframe,
+    kusto_columns_to_dataframe,
+)
+from .cache import default_result_cache, result_cache_key
+from .config import direct
+from .utils.chunking import ChunkRuntimeHistory, GroupedChunkList
+from .utils.concurrency import imap_bounded, interleave_groups, map_bounded
+from .utils.sketch import sketch_log_gamma, sketch_percentiles
+from .utils.throttling import ApiFamily, default_request_scheduler, scheduled_call
+from .utils.storage import read_dataframe, read_json, write_dataframe, write_json
 from .utils.types import realize_sequence
 
 
@@ -26,10 +44,22 @@ class PerformanceCounterSpec(NamedTuple):
     value_transform: Optional[str] = None
 
 
-def build_perf_counter_percentile_query(resource_ids: List[str], spec: PerformanceCounterSpec) -> str:
-    where_clause = f"where ObjectName == '{spec.object_}' and CounterName == '{spec.counter}'"
+def perf_counter_name(spec: PerformanceCounterSpec) -> str:
+    name = f"{spec.object_}\\{spec.counter}"
     if spec.instance:
-        where_clause += f" and InstanceName == '{spec.instance}'"
+        name += f"({spec.instance})"
+    return name
+
+
+def _perf_counter_condition(spec: PerformanceCounterSpec) -> str:
+    condition = f"ObjectName == '{spec.object_}' and CounterName == '{spec.counter}'"
+    if spec.instance:
+        condition += f" and InstanceName == '{spec.instance}'"
+    return condition
+
+
+def build_perf_counter_percentile_query(resource_ids: List[str], spec: PerformanceCounterSpec) -> str:
+    where_clause = f"where {_perf_counter_condition(spec)}"
     transform_pipe = ""
     if spec.value_transform:
         transform_pipe = f"\n        | extend value = {spec.value_transform}"
@@ -46,6 +76,34 @@ def build_perf_counter_percentile_query(resource_ids: List[str], spec: Performan
     return query
 
 
+def build_multi_counter_percentile_query(
+    resource_ids: List[str], specs: Sequence[PerformanceCounterSpec]
+) -> str:
+    # One pass over Perf for all counters. Rows are keyed by resource_id and counter, where counter
+    # is perf_counter_name(spec).
+    conditions = [_perf_counter_condition(spec) for spec in specs]
+    names = [serialize_to_kql(perf_counter_name(spec)) for spec in specs]
+    where_clause = " or ".join(f"({condition})" for condition in conditions)
+    counter_case = ", ".join(f"{condition}, {name}" for condition, name in zip(conditions, names))
+    transform_pipe = ""
+    transforms = [(name, spec.value_transform) for name, spec in zip(names, specs) if spec.value_transform]
+    if transforms:
+        transform_case = ", ".join(f"counter == {name}, {transform}" for name, transform in transforms)
+        transform_pipe = f"\n        | extend value = case({transform_case}, value)"
+    query = textwrap.dedent(f"""
+        let vm_ids = {serialize_to_kql(resource_ids)}; 
+        Perf 
+        | where _ResourceId in (vm_ids)
+        | where {where_clause}
+        | extend counter = case({counter_case}, '')
+        | project TimeGenerated, _ResourceId, counter, value=CounterValue
+        | summarize value=avg(value) by _ResourceId, counter, bin(TimeGenerated, 1m) {transform_pipe}
+        | summarize percentiles(value, 50, 80, 90, 95, 99), max(value), samples=count() by _ResourceId, counter
+        | project resource_id = _ResourceId, counter, percentile_50th = percentile_value_50, percentile_80th = percentile_value_80, percentile_90th = percentile_value_90, percentile_95th = percentile_value_95, percentile_99th = percentile_value_99, max = max_value, samples
+        """)
+    return query
+
+
 def build_disk_percentile_query(resource_ids: List[str]) -> str:
     query = textwrap.dedent(f"""
         let vm_ids = {serialize_to_kql(resource_ids)}; 
@@ -61,31 +119,315 @@ def build_disk_percentile_query(resource_ids: List[str]) -> str:
     return query
 
 
+def build_perf_counter_sketch_query(
+    resource_ids: Sequence[str], spec: PerformanceCounterSpec, relative_accuracy: float = 0.01
+) -> str:
+    # Like build_perf_counter_percentile_query, but returns a mergeable sketch (see utils.sketch) of
+    # the per-minute values instead of percentiles, so results for separate time slices can be combined.
+    where_clause = f"where {_perf_counter_condition(spec)}"
+    transform_pipe = ""
+    if spec.value_transform:
+        transform_pipe = f"\n        | extend value = {spec.value_transform}"
+    query = textwrap.dedent(f"""
+        let vm_ids = {serialize_to_kql(resource_ids)}; 
+        Perf 
+        | where _ResourceId in (vm_ids)
+        | {where_clause}
+        | project TimeGenerated, _ResourceId, value=CounterValue
+        | summarize value=avg(value) by _ResourceId, bin(TimeGenerated, 1m) {transform_pipe}
+        | extend sign = toint(sign(value)), bucket = iff(value == 0, 0, toint(ceiling(log(abs(value)) / {sketch_log_gamma(relative_accuracy)!r})))
+        | summarize samples=count(), max=max(value) by _ResourceId, sign, bucket
+        | project resource_id = _ResourceId, sign, bucket, samples, max
+        """)
+    return query
+
+
+def build_resource_weight_query(resource_ids: List[str], table: str = 'Perf') -> str:
+    # A cheap pre-query for build_cost_balanced_chunk_list: the billed bytes each resource
+    # ingested into table, which tracks how much a query over that table has to scan.
+    query = textwrap.dedent(f"""
+        let vm_ids = {serialize_to_kql(resource_ids)}; 
+        {table} 
+        | where _ResourceId in (vm_ids)
+        | summarize weight = sum(_BilledSize) by _ResourceId
+        | project resource_id = _ResourceId, weight
+        """)
+    return query
+
+
+def query_resource_weights(
+    chunked_ids: GroupedChunkList,
+    table: str = 'Perf',
+    timespan: str = 'P1D',
+    logger=None,
+    max_concurrency: int = 1,
+) -> Dict[str, float]:
+    """Billed bytes per resource id (lower case) in table over timespan, from build_resource_weight_query."""
+    query_builder = functools.partial(build_resource_weight_query, table=table)
+    result = query_dataframe_by_workspace_chunk(
+        chunked_ids, query_builder, timespan, logger, max_concurrency
+    ).primary_result
+    weights = result.groupby(result['resource_id'].str.lower())['weight'].sum()
+    return {resource_id: float(weight) for resource_id, weight in weights.items()}
+
+
+def default_chunk_runtime_history(name: str) -> ChunkRuntimeHistory:
+    settings = direct()['azmeta']['chunk_history']
+    if settings['directory'].get() is None:
+        directory = os.path.join(direct().config_dir(), 'chunk_history')
+    else:
+        directory = settings['directory'].as_filename()
+    return ChunkRuntimeHistory(os.path.join(directory, f'{name}.json'))
+
+
 def query_kusto(query: str, workspaces: Union[Iterable[str], str], timespan: str = None) -> KustoResponseDataSet:
     query_response = _query_native(query, workspaces, timespan)
     data = _parse_raw_response_to_data_dict(query_response, hide_primary_data=False)
     return _create_kusto_result(data)
 
 
-def query_dataframe(query: str, workspaces: Union[Iterable[str], str], timespan: str = None) -> KustoDataFrameResponse:
+def query_dataframe(
+    query: str,
+    workspaces: Union[Iterable[str], str],
+    timespan: str = None,
+    cache: Optional[bool] = None,
+    decode_options: Optional[KustoDecodeOptions] = None,
+) -> KustoDataFrameResponse:
+    """Run a Log Analytics query and return its tables as DataFrames.
+
+    Only the tables are kept in the result cache, so a response served from it has no
+    native_response. Responses that reported errors are not cached.
+    """
+    if not isinstance(workspaces, str):
+        workspaces = realize_sequence(workspaces)
+    result_cache = default_result_cache(cache)
+    if result_cache:
+        scope = workspaces if isinstance(workspaces, str) else sorted(workspaces)
+        cache_key = result_cache_key('monitor_logs', query, scope, timespan, decode_options)
+        tables = result_cache.get(cache_key)
+        if tables is not None:
+            return KustoDataFrameResponse(tables)
+
     query_response = _query_native(query, workspaces, timespan)
     data = _parse_raw_response_to_data_dict(query_response, hide_primary_data=True)
-    return _create_dataframe_result(data, _create_kusto_result(data))
-
-
-def query_kusto_by_workspace_chunk(chunked_ids: GroupedChunkList, query_builder, timespan: str = None, logger = None) -> KustoResponseDataSet:
-    data_dicts = _query_native_by_workspace_chunk(chunked_ids, query_builder, timespan, logger)
-    data = _merge_data_dicts(data_dicts, unhide_primary_data=True)
+    kusto_response = _create_kusto_result(data)
+    result = _create_dataframe_result(data, kusto_response, decode_options)
+    if result_cache and kusto_response.errors_count == 0:
+        result_cache.put(cache_key, result.tables, immutable=_is_closed_timespan(timespan))
+    return result
+
+
+def _is_closed_timespan(timespan: Optional[str]) -> bool:
+    # Only absolute 'start/end' intervals that ended before the ingestion latency window are immutable.
+    if timespan is None or timespan.count('/') != 1:
+        return False
+    try:
+        end = Timestamp(timespan.split('/')[1])
+    except ValueError:
+        return False
+    if end.tzinfo is None:
+        end = end.tz_localize('UTC')
+    return end + _ingestion_latency < Timestamp.now(tz='UTC')
+
+
+_ingestion_latency = timedelta(days=1)
+
+
+def query_kusto_by_workspace_chunk(
+    chunked_ids: GroupedChunkList,
+    query_builder,
+    timespan: str = None,
+    logger=None,
+    max_concurrency: int = 1,
+    max_concurrency_per_workspace: Optional[int] = None,
+    adaptive_split: bool = True,
+    runtime_history: Optional[ChunkRuntimeHistory] = None,
+) -> KustoResponseDataSet:
+    data_dicts = _query_native_by_workspace_chunk(
+        chunked_ids,
+        query_builder,
+        timespan,
+        logger,
+        max_concurrency,
+        max_concurrency_per_workspace,
+        hide_primary_data=False,
+        adaptive_split=adaptive_split,
+        runtime_history=runtime_history,
+    )
+    data = _merge_data_dicts(data_dicts)
     return _create_kusto_result(data)
 
 
-def query_dataframe_by_workspace_chunk(chunked_ids: GroupedChunkList, query_builder, timespan: str = None, logger = None) -> KustoDataFrameResponse:
-    data_dicts = _query_native_by_workspace_chunk(chunked_ids, query_builder, timespan, logger)
+def query_dataframe_by_workspace_chunk(
+    chunked_ids: GroupedChunkList,
+    query_builder,
+    timespan: str = None,
+    logger=None,
+    max_concurrency: int = 1,
+    max_concurrency_per_workspace: Optional[int] = None,
+    adaptive_split: bool = True,
+    run_id: Optional[str] = None,
+    decode_options: Optional[KustoDecodeOptions] = None,
+    runtime_history: Optional[ChunkRuntimeHistory] = None,
+) -> KustoDataFrameResponse:
+    if run_id is not None:
+        dataframes = iter_dataframes_by_workspace_chunk(
+            chunked_ids,
+            query_builder,
+            timespan,
+            logger,
+            max_concurrency,
+            max_concurrency_per_workspace,
+            adaptive_split,
+            run_id=run_id,
+            decode_options=decode_options,
+            runtime_history=runtime_history,
+        )
+        return KustoDataFrameResponse([concat(list(dataframes), ignore_index=True)])
+
+    data_dicts = _query_native_by_workspace_chunk(
+        chunked_ids,
+        query_builder,
+        timespan,
+        logger,
+        max_concurrency,
+        max_concurrency_per_workspace,
+        hide_primary_data=True,
+        adaptive_split=adaptive_split,
+        runtime_history=runtime_history,
+    )
     data = _merge_data_dicts(data_dicts)
-    return _create_dataframe_result(data, _create_kusto_result(data_dicts[0]))
-
-
-def _load_as_kusto_format(dct: dict, hide_primary_data: bool):
+    return _create_dataframe_result(data, _create_kusto_result(data), decode_options)
+
+
+def iter_dataframes_by_workspace_chunk(
+    chunked_ids: GroupedChunkList,
+    query_builder,
+    timespan: str = None,
+    logger=None,
+    max_concurrency: int = 1,
+    max_concurrency_per_workspace: Optional[int] = None,
+    adaptive_split: bool = True,
+    run_id: Optional[str] = None,
+    spill_directory: Optional[str] = None,
+    decode_options: Optional[KustoDecodeOptions] = None,
+    runtime_history: Optional[ChunkRuntimeHistory] = None,
+) -> Iterator[DataFrame]:
+    """Yield the primary result of each chunk as a DataFrame, in chunk order, as soon as it is decoded.
+
+    With max_concurrency_per_workspace set, chunk order takes the workspaces round-robin.
+
+    Only the chunks in flight are held in memory. When spill_directory is set each chunk is also
+    written there as chunk-NNNNN.parquet before it is yielded. When run_id is set chunks are
+    checkpointed, and chunks finished by an earlier run with the same run_id are loaded instead of
+    queried. When runtime_history is set the runtime of every query is recorded in it and saved
+    at the end, for planning later runs with build_cost_balanced_chunk_list.
+    """
+    chunk_query = _ChunkQuery(
+        query_builder,
+        timespan,
+        logger,
+        len(chunked_ids),
+        True,
+        _WorkspaceChunkSizes() if adaptive_split else None,
+        runtime_history,
+    )
+
+    def run_chunk(chunk_work: _ChunkWork) -> Tuple[DataFrame, int]:
+        datas, errors = chunk_query.run(chunk_work)
+        return _table_to_dataframe(_merge_data_dicts(datas)['Tables'][0], decode_options), errors
+
+    run: Callable[[_ChunkWork], Tuple[DataFrame, int]] = run_chunk
+    if run_id is not None:
+        run = _checkpointed_chunk_runner(
+            run_chunk, chunked_ids, query_builder, timespan, logger, run_id, decode_options
+        )
+    if spill_directory is not None:
+        os.makedirs(spill_directory, exist_ok=True)
+
+    try:
+        for index, dataframe in enumerate(
+            _iter_chunk_results(chunked_ids, run, logger, max_concurrency, max_concurrency_per_workspace)
+        ):
+            if spill_directory is not None:
+                write_dataframe(os.path.join(spill_directory, f'chunk-{index:05d}.parquet'), dataframe)
+            yield dataframe
+    finally:
+        if runtime_history is not None:
+            runtime_history.save()
+
+
+def query_perf_counter_percentiles_by_time_slice(
+    chunked_ids: GroupedChunkList,
+    spec: PerformanceCounterSpec,
+    start: datetime,
+    end: datetime,
+    logger,
+    slice_length: timedelta = timedelta(days=1),
+    relative_accuracy: float = 0.01,
+    max_slice_concurrency: int = 1,
+    max_concurrency: int = 1,
+    max_concurrency_per_workspace: Optional[int] = None,
+    cache: Optional[bool] = None,
+) -> DataFrame:
+    """Percentiles of a counter over [start, end), queried one time slice at a time.
+
+    Each slice returns a sketch per resource that is merged locally, so no single query scans the
+    whole window. Slices are aligned to multiples of slice_length, and closed slices are cached
+    without expiry when the result cache is enabled, so extending a report only queries new slices.
+    Returns the same columns as build_perf_counter_percentile_query, with percentiles within
+    relative_accuracy of the exact values.
+    """
+    query_builder = functools.partial(
+        build_perf_counter_sketch_query, spec=spec, relative_accuracy=relative_accuracy
+    )
+    result_cache = default_result_cache(cache)
+
+    def query_slice(time_slice: Tuple[datetime, datetime]) -> DataFrame:
+        timespan = '/'.join(t.strftime('%Y-%m-%dT%H:%M:%SZ') for t in time_slice)
+        if result_cache:
+            queries = [query_builder(chunk) for group in chunked_ids.groups for chunk in group.chunks]
+            cache_key = result_cache_key(
+                'monitor_logs.sketch', queries, [group.id for group in chunked_ids.groups], timespan
+            )
+            tables = result_cache.get(cache_key)
+            if tables is not None:
+                logger.info(f'Loaded sketch for {timespan} from cache.')
+                return tables[0]
+
+        logger.info(f'Querying sketch for {timespan}.')
+        sketch = query_dataframe_by_workspace_chunk(
+            chunked_ids, query_builder, timespan, logger, max_concurrency, max_concurrency_per_workspace
+        ).primary_result
+        if result_cache:
+            result_cache.put(cache_key, [sketch], immutable=_is_closed_timespan(timespan))
+        return sketch
+
+    sketches = map_bounded(query_slice, _time_slices(start, end, slice_length), max_slice_concurrency)
+    return sketch_percentiles(
+        concat(sketches, ignore_index=True), ['resource_id'], (50, 80, 90, 95, 99), relative_accuracy
+    )
+
+
+def _time_slices(start: datetime, end: datetime, slice_length: timedelta) -> List[Tuple[datetime, datetime]]:
+    start, end = _as_utc(start), _as_utc(end)
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    boundary = epoch + ((start - epoch) // slice_length + 1) * slice_length
+    slices = []
+    while start < end:
+        slices.append((start, min(boundary, end)))
+        start = boundary
+        boundary += slice_length
+    return slices
+
+
+def _as_utc(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def _load_as_kusto_format(dct: dict):
     def mapped(map: dict):
         return {map[k] if k in map else k: v for k,v in dct.items()}
 
@@ -93,11 +435,7 @@ def _load_as_kusto_format(dct: dict, hide_primary_data: bool):
         return mapped(_load_as_kusto_format_col_map)
 
     if 'name' in dct and 'rows' in dct:
-        new_dct = mapped(_load_as_kusto_format_table_map)
-        if hide_primary_data:
-            new_dct['_Rows_'] = new_dct['Rows']
-            new_dct['Rows'] = []
-        return new_dct
+        return mapped(_load_as_kusto_format_table_map)
 
     if 'tables' in dct:
         return mapped(_load_as_kusto_format_response_map)
@@ -111,20 +449,133 @@ _load_as_kusto_format_response_map = { 'tables': 'Tables' }
 
 
 def _parse_raw_response_to_data_dict(raw_response: ClientRawResponse, hide_primary_data: bool) -> dict:
-    load_json: Callable[[bytes], dict] = lambda content: json.loads(content, object_hook=functools.partial(_load_as_kusto_format, hide_primary_data = hide_primary_data))
-    return load_json(raw_response.response.content)
-
-
-def _merge_data_dicts(datas: List[dict], unhide_primary_data: bool = False) -> dict:
+    content = raw_response.response.content
+    if hide_primary_data:
+        # Release the response body before the buffers are built, so the body bytes, its decoded
+        # text and the buffers are never all held at once.
+        raw_response.response = None
+        text = content.decode('utf-8')
+        del content
+        return _load_as_kusto_format_columnar(text)
+    return json.loads(content, object_hook=_load_as_kusto_format)
+
+
+def _load_as_kusto_format_columnar(text: str) -> dict:
+    # Decodes the response one row at a time. Rows of the primary (first) table go straight into
+    # column buffers under '_Columns_' and its 'Rows' is left empty, so the primary table is never
+    # materialized as row lists or a JSON tree; peak memory is the response text plus the buffers.
+    # The remaining tables are small and loaded as is.
+    reader = _JsonReader(text)
+    response: dict = {}
+    for key in reader.members():
+        if key == 'tables':
+            response['Tables'] = [
+                _read_table_columnar(reader, buffer_rows=index == 0) for index in reader.elements()
+            ]
+        else:
+            response[_load_as_kusto_format_response_map.get(key, key)] = reader.value()
+    return response
+
+
+def _read_table_columnar(reader: '_JsonReader', buffer_rows: bool) -> dict:
+    table: dict = {}
+    for key in reader.members():
+        if key == 'columns':
+            table['Columns'] = [_load_as_kusto_format(c) for c in reader.value()]
+        elif key == 'rows' and buffer_rows and 'Columns' in table:
+            buffers = [ColumnBuffer(c['ColumnType']) for c in table['Columns']]
+            appenders = [b.append for b in buffers]
+            for _ in reader.elements():
+                for append, value in zip(appenders, reader.value()):
+                    append(value)
+            table['Rows'] = []
+            table['_Columns_'] = buffers
+        else:
+            table[_load_as_kusto_format_table_map.get(key, key)] = reader.value()
+
+    if buffer_rows and '_Columns_' not in table:
+        buffers = [ColumnBuffer(c['ColumnType']) for c in table['Columns']]
+        for row in table['Rows']:
+            for buffer, value in zip(buffers, row):
+                buffer.append(value)
+        table['Rows'] = []
+        table['_Columns_'] = buffers
+    return table
+
+
+class _JsonReader:
+    _decoder = json.JSONDecoder()
+    _whitespace = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, text: str):
+        self._text = text
+        self._pos = 0
+
+    def value(self) -> Any:
+        self._skip()
+        value, self._pos = self._decoder.raw_decode(self._text, self._pos)
+        return value
+
+    def members(self) -> Iterator[str]:
+        # Yields each key of an object; the caller must consume the member's value before resuming.
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self._expect(':')
+            yield key
+            if self._next_separator('}'):
+                return
+
+    def elements(self) -> Iterator[int]:
+        # Yields the index of each array element; the caller must consume the element before resuming.
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+        index = 0
+        while True:
+            yield index
+            index += 1
+            if self._next_separator(']'):
+                return
+
+    def _skip(self) -> None:
+        self._pos = self._whitespace.match(self._text, self._pos).end()  # type: ignore
+
+    def _peek(self) -> str:
+        self._skip()
+        return self._text[self._pos:self._pos + 1]
+
+    def _expect(self, token: str) -> None:
+        if self._peek() != token:
+            raise ValueError(f'Expected {token!r} at position {self._pos} of response.')
+        self._pos += 1
+
+    def _next_separator(self, closing: str) -> bool:
+        token = self._peek()
+        self._pos += 1
+        if token == closing:
+            return True
+        if token != ',':
+            raise ValueError(f'Expected {closing!r} or \',\' at position {self._pos - 1} of response.')
+        return False
+
+
+def _merge_data_dicts(datas: List[dict]) -> dict:
     merged_data = datas[0]
-    if unhide_primary_data:
-        merged_data['Tables'][0]['Rows'] = merged_data['Tables'][0]['_Rows_']
-        target_row_list_name = 'Rows'
-    else:
-        target_row_list_name = '_Rows_'
+    merged_table = merged_data['Tables'][0]
     for chunk_data in datas[1:]:
-        chunk_rows = chunk_data['Tables'][0]['_Rows_']
-        merged_data['Tables'][0][target_row_list_name].extend(chunk_rows)
+        chunk_table = chunk_data['Tables'][0]
+        if '_Columns_' in merged_table:
+            for buffer, chunk_buffer in zip(merged_table['_Columns_'], chunk_table['_Columns_']):
+                buffer.extend(chunk_buffer)
+            chunk_table['_Columns_'] = None
+        else:
+            merged_table['Rows'].extend(chunk_table['Rows'])
+            chunk_table['Rows'] = None
 
     return merged_data
 
@@ -133,19 +584,24 @@ def _create_kusto_result(data: dict) -> KustoResponseDataSet:
     return KustoResponseDataSetV1(data)
 
 
-def _create_dataframe_result(data: dict, kusto_response: KustoResponseDataSet) -> KustoDataFrameResponse:
+def _create_dataframe_result(
+    data: dict, kusto_response: KustoResponseDataSet, decode_options: Optional[KustoDecodeOptions] = None
+) -> KustoDataFrameResponse:
     dataframes = []
     for table in kusto_response.tables:
         if table.table_kind == WellKnownDataSet.PrimaryResult:
-            table_data = data['Tables'][table.table_id]
-            columns = [KustoColumnDescriptor(c['ColumnName'], c['ColumnType']) for c in table_data['Columns']]
-            rows = table_data['_Rows_']
-            dataframe = kusto_data_to_dataframe(columns, rows) 
-            dataframes.append(dataframe)
+            dataframes.append(_table_to_dataframe(data['Tables'][table.table_id], decode_options))
 
     return KustoDataFrameResponse(dataframes, kusto_response)
 
 
+def _table_to_dataframe(table_data: dict, decode_options: Optional[KustoDecodeOptions] = None) -> DataFrame:
+    columns = [KustoColumnDescriptor(c['ColumnName'], c['ColumnType']) for c in table_data['Columns']]
+    if '_Columns_' in table_data:
+        return kusto_columns_to_dataframe(columns, table_data['_Columns_'], decode_options)
+    return kusto_data_to_dataframe(columns, table_data['Rows'], decode_options)
+
+
 def _query_native(query: str, workspaces: Union[Iterable[str], str], timespan: Optional[str], timeout: int = None, retries: int = None) -> ClientRawResponse:
     client = default_sdk_client(LogAnalyticsDataClient, auth_resource="https://api.loganalytics.io/")
     client._deserialize = lambda x,y: None
@@ -163,48 +619,280 @@ def _query_native(query: str, workspaces: Union[Iterable[str], str], timespan: O
         custom_headers = { 'Prefer': f'wait={timeout}' }
     if retries is not None:
         operation_config['retries'] = retries
-    return client.query(workspace, query_request, custom_headers=custom_headers, raw=True, **operation_config)
+    return scheduled_call(
+        ApiFamily.log_analytics,
+        lambda: client.query(
+            workspace, query_request, custom_headers=custom_headers, raw=True, **operation_config
+        ),
+    )
+
+
+def _query_native_by_workspace_chunk(
+    chunked_ids: GroupedChunkList,
+    query_builder,
+    timespan: Optional[str],
+    logger,
+    max_concurrency: int = 1,
+    max_concurrency_per_workspace: Optional[int] = None,
+    hide_primary_data: bool = True,
+    adaptive_split: bool = True,
+    runtime_history: Optional[ChunkRuntimeHistory] = None,
+) -> List[dict]:
+    chunk_query = _ChunkQuery(
+        query_builder,
+        timespan,
+        logger,
+        len(chunked_ids),
+        hide_primary_data,
+        _WorkspaceChunkSizes() if adaptive_split else None,
+        runtime_history,
+    )
+    chunk_results = _iter_chunk_results(
+        chunked_ids, chunk_query.run, logger, max_concurrency, max_concurrency_per_workspace
+    )
+    try:
+        return [data for datas in chunk_results for data in datas]
+    finally:
+        if runtime_history is not None:
+            runtime_history.save()
+
+
+def _checkpointed_chunk_runner(
+    run_chunk: Callable[['_ChunkWork'], Tuple[DataFrame, int]],
+    chunked_ids: GroupedChunkList,
+    query_builder,
+    timespan: Optional[str],
+    logger,
+    run_id: str,
+    decode_options: Optional[KustoDecodeOptions],
+) -> Callable[['_ChunkWork'], Tuple[DataFrame, int]]:
+    # Each chunk's primary table is written to the run directory as soon as it completes. Chunks
+    # already in the directory are loaded instead of queried, so a failed run can be resumed.
+    run_directory = checkpoint_run_directory(run_id)
+    os.makedirs(run_directory, exist_ok=True)
+
+    manifest_path = os.path.join(run_directory, 'manifest.json')
+    fingerprint = _chunk_list_fingerprint(chunked_ids, query_builder, timespan, decode_options)
+    manifest = read_json(manifest_path)
+    if manifest is None:
+        write_json(manifest_path, {'fingerprint': fingerprint, 'chunks': len(chunked_ids)})
+    elif manifest['fingerprint'] != fingerprint:
+        raise ValueError(
+            f'Checkpoint run {run_id} was created for a different chunk list, query or timespan.'
+        )
+
+    def run_checkpointed_chunk(chunk_work: _ChunkWork) -> Tuple[DataFrame, int]:
+        chunk_path = os.path.join(run_directory, f'chunk-{chunk_work.chunk_index:05d}.parquet')
+        if os.path.exists(chunk_path):
+            logger.info(f'Loaded chunk {chunk_work.chunk_index + 1}/{len(chunked_ids)} from checkpoint.')
+            return read_dataframe(chunk_path), 0
+        dataframe, errors = run_chunk(chunk_work)
+        if errors == 0:
+            write_dataframe(chunk_path, dataframe)
+        return dataframe, errors
+
+    return run_checkpointed_chunk
+
+
+def checkpoint_run_directory(run_id: str) -> str:
+    settings = direct()['azmeta']['checkpoints']
+    if settings['directory'].get() is None:
+        directory = os.path.join(direct().config_dir(), 'checkpoints')
+    else:
+        directory = settings['directory'].as_filename()
+    return os.path.join(directory, run_id)
+
+
+def discard_checkpoint_run(run_id: str) -> None:
+    shutil.rmtree(checkpoint_run_directory(run_id), ignore_errors=True)
+
 
+def _chunk_list_fingerprint(
+    chunked_ids: GroupedChunkList,
+    query_builder,
+    timespan: Optional[str],
+    decode_options: Optional[KustoDecodeOptions],
+) -> str:
+    groups = [[group.id, [list(chunk) for chunk in group.chunks]] for group in chunked_ids.groups]
+    first_query = query_builder(chunked_ids.groups[0].chunks[0]) if chunked_ids.groups else None
+    return result_cache_key('monitor_logs.checkpoint', first_query, groups, timespan, decode_options)
 
-def _query_native_by_workspace_chunk(chunked_ids: GroupedChunkList, query_builder, timespan: Optional[str], logger) -> List[dict]:
+
+def _iter_chunk_results(
+    chunked_ids: GroupedChunkList,
+    run_chunk: Callable[['_ChunkWork'], Tuple[Any, int]],
+    logger,
+    max_concurrency: int,
+    max_concurrency_per_workspace: Optional[int],
+) -> Iterator[Any]:
     logger.info(f'Starting chunked query with {len(chunked_ids)} chunk(s) over {len(chunked_ids.groups)} workspace(s).')
-    chunk_index = 0
-    total_errors = 0
-    responses: List[dict] = []
+    work: List[_ChunkWork] = []
     for workspace_group in chunked_ids.groups:
-        current_chunks = workspace_group.chunks
-        current_workspace_id = workspace_group.id
-        logger.info(f'Querying {len(current_chunks)} chunk(s) in workspace {current_workspace_id}.')
-        for chunk_data in current_chunks:
-            logger.debug(f'Querying {len(chunk_data)} resource(s).', resources=chunk_data)
-            attempt = 0
-            while True:
-                kql_query = query_builder(chunk_data)
-                query_result = None
-                try:
-                    query_result = _query_native(kql_query, current_workspace_id, timespan, timeout = 300, retries = 0)
-                except ClientRequestError as error:
-                    if attempt == 5:
-                        raise
-                    if isinstance(error.inner_exception, Timeout):
-                        logger.warning('Request timed out.')
-                    else:
-                        logger.debug(f'Request failed: {error}. Waiting 5 seconds...')
-                        time.sleep(5)
-                if query_result is not None:
-                    break
-                attempt += 1
-                logger.warning(f'Retrying last query (attempt {attempt}/5)')
-            data = _parse_raw_response_to_data_dict(query_result, hide_primary_data=True)
-            kusto_response = _create_kusto_result(data)
-            errors = kusto_response.errors_count
-            logger.info(f'Query for chunk {chunk_index + 1}/{len(chunked_ids)} complete with {errors} error(s).')
-            if errors:
-                total_errors += errors
-            responses.append(data)
-            chunk_index += 1
+        logger.info(f'Querying {len(workspace_group.chunks)} chunk(s) in workspace {workspace_group.id}.')
+        work.extend(
+            _ChunkWork(index, workspace_group.id, chunk_data)
+            for index, chunk_data in enumerate(workspace_group.chunks, start=len(work))
+        )
+    if max_concurrency_per_workspace is not None:
+        # Results come back in work order, so with chunks of one workspace in a row its limit would
+        # also cap the overall concurrency.
+        work = interleave_groups(work, lambda w: w.workspace_id)
+
+    total_errors = 0
+    chunk_results = imap_bounded(
+        run_chunk, work, max_concurrency, lambda w: w.workspace_id, max_concurrency_per_workspace
+    )
+    for result, errors in chunk_results:
+        total_errors += errors
+        yield result
 
     level = logging.ERROR if total_errors > 0 else logging.INFO
     logger.log(level, f'Finished chunked query with {total_errors} errors(s).')
-    return responses
 
+
+class _ChunkWork(NamedTuple):
+    chunk_index: int
+    workspace_id: str
+    chunk_data: Sequence[Any]
+
+
+class _WorkspaceChunkSizes:
+    """The largest chunk size known to succeed in each workspace after a chunk had to be split."""
+
+    def __init__(self):
+        self._sizes: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, workspace_id: str) -> Optional[int]:
+        with self._lock:
+            return self._sizes.get(workspace_id)
+
+    def record(self, workspace_id: str, size: int) -> None:
+        with self._lock:
+            self._sizes[workspace_id] = min(size, self._sizes.get(workspace_id, size))
+
+
+class _ChunkQuery(NamedTuple):
+    query_builder: Callable[[Sequence[Any]], str]
+    timespan: Optional[str]
+    logger: Any
+    total_chunks: int
+    hide_primary_data: bool
+    chunk_sizes: Optional[_WorkspaceChunkSizes]
+    runtime_history: Optional[ChunkRuntimeHistory] = None
+
+    def run(self, chunk_work: _ChunkWork) -> Tuple[List[dict], int]:
+        chunk_data = chunk_work.chunk_data
+        self.logger.debug(f'Querying {len(chunk_data)} resource(s).', resources=chunk_data)
+        size = (self.chunk_sizes and self.chunk_sizes.get(chunk_work.workspace_id)) or len(chunk_data)
+        datas: List[dict] = []
+        errors = 0
+        for start in range(0, len(chunk_data), size):
+            piece_datas, piece_errors = self._query_resources(
+                chunk_work.workspace_id, chunk_data[start : start + size], split_depth=0
+            )
+            datas.extend(piece_datas)
+            errors += piece_errors
+        self.logger.info(
+            f'Query for chunk {chunk_work.chunk_index + 1}/{self.total_chunks} '
+            f'complete with {errors} error(s).'
+        )
+        return datas, errors
+
+    def _query_resources(
+        self, workspace_id: str, resources: Sequence[Any], split_depth: int
+    ) -> Tuple[List[dict], int]:
+        can_split = self.chunk_sizes is not None and len(resources) > 1
+        data = self._query_with_retry(workspace_id, resources, can_split)
+        if data is None:
+            half = len(resources) // 2
+            self.logger.warning(
+                f'Splitting {len(resources)} resource(s) into chunks of {half} and {len(resources) - half}.'
+            )
+            first_datas, first_errors = self._query_resources(workspace_id, resources[:half], split_depth + 1)
+            second_datas, second_errors = self._query_resources(
+                workspace_id, resources[half:], split_depth + 1
+            )
+            return first_datas + second_datas, first_errors + second_errors
+
+        if split_depth > 0:
+            self.chunk_sizes.record(workspace_id, len(resources))  # type: ignore
+        errors = _create_kusto_result(data).errors_count
+        if _is_result_truncated(data):
+            self.logger.error(
+                f'Results for {len(resources)} resource(s) are truncated by the service limits.',
+                resources=resources,
+            )
+            errors += 1
+        return [data], errors
+
+    def _query_with_retry(
+        self, workspace_id: str, resources: Sequence[Any], can_split: bool
+    ) -> Optional[dict]:
+        # Returns None when the resources should be split and resubmitted instead.
+        attempt = 0
+        while True:
+            kql_query = self.query_builder(resources)
+            query_result = None
+            started = time.monotonic()
+            try:
+                query_result = _query_native(kql_query, workspace_id, self.timespan, timeout=300, retries=0)
+            except ClientRequestError as error:
+                timed_out = isinstance(error.inner_exception, Timeout)
+                if timed_out and can_split:
+                    self.logger.warning('Request timed out.')
+                    return None
+                if attempt == 5:
+                    raise
+                if timed_out:
+                    self.logger.warning('Request timed out.')
+                else:
+                    delay = default_request_scheduler().backoff_delay(attempt)
+                    self.logger.debug(f'Request failed: {error}. Waiting {delay:.0f} seconds...')
+                    time.sleep(delay)
+            except HttpOperationError as error:
+                if not _is_server_timeout(error):
+                    raise
+                self.logger.warning('Query timed out on the server.')
+                if can_split:
+                    return None
+                if attempt == 5:
+                    raise
+            if query_result is not None:
+                break
+            attempt += 1
+            self.logger.warning(f'Retrying last query (attempt {attempt}/5)')
+
+        data = _parse_raw_response_to_data_dict(query_result, self.hide_primary_data)
+        if can_split and _is_result_truncated(data):
+            self.logger.warning('Query result was truncated by the service limits.')
+            return None
+        if self.runtime_history is not None:
+            self.runtime_history.record(resources, time.monotonic() - started)
+        return data
+
+
+def _is_server_timeout(error: HttpOperationError) -> bool:
+    response = error.response
+    if response is None:
+        return False
+    return response.status_code == 504 or 'timeout' in response.text.lower()
+
+
+def _is_result_truncated(data: dict) -> bool:
+    error = data.get('error')
+    if error is not None:
+        error_text = json.dumps(error)
+        if any(marker in error_text for marker in _result_truncation_markers):
+            return True
+
+    table = data['Tables'][0]
+    if table.get('_Columns_'):
+        row_count = len(table['_Columns_'][0])
+    else:
+        row_count = len(table['Rows'])
+    return row_count >= _result_row_limit
+
+
+_result_row_limit = 500000
+_result_truncation_markers = ('E_QUERY_RESULT_SET_TOO_LARGE', 'exceeded the internal')
@@ -5,6 +5,7 @@ from azure.mgmt.reservations.operations._reservation_operations import Reservati
 from typing import List, Iterable, Tuple, Any
 from pandas import DataFrame
 import pandas
+from .utils.throttling import ApiFamily, scheduled_call
 
 
 
@@ -41,7 +42,7 @@ def _reservations_native() -> List[ReservationResponse]:
         # Monkey Patch the Python SDK. A wrapper for this functionality is missing.
         ReservationOperations.list.metadata['url'] = '/providers/Microsoft.Capacity/reservations'
         # list() input is ignored due to patch above.
-        all_results = list(api.reservation.list('*'))
+        all_results = scheduled_call(ApiFamily.arm, lambda: list(api.reservation.list('*')))
     finally:
         ReservationOperations.list.metadata['url'] = original_url
     
@@ -1,25 +1,71 @@
 from azmeta.access.utils.sdk import default_sdk_client
 from azure.mgmt.resourcegraph import ResourceGraphClient
 from azure.mgmt.resourcegraph.models import QueryRequest, QueryRequestOptions, QueryResponse, ResultTruncated
-from typing import List, Iterable, Tuple, Any
-from pandas import DataFrame
+from typing import List, Iterable, Tuple, Any, Optional, Sequence
+from pandas import DataFrame, concat
+import functools
 import itertools
 
+from .cache import default_result_cache, result_cache_key
+from .utils.concurrency import map_bounded
+from .utils.throttling import ApiFamily, scheduled_call
 from .utils.types import realize_sequence
-from .kusto import KustoColumnDescriptor, kusto_data_to_dataframe
+from .kusto import KustoColumnDescriptor, KustoDecodeOptions, kusto_data_to_dataframe
 
 
-def query_native(subscriptions: Iterable[str], query: str, max_pages = 10) -> List[QueryResponse]:
-    return _query_native(subscriptions, query, max_pages)
+class ResourceGraphResultTooLargeError(RuntimeError):
+    """The result of a query was truncated or needs more than max_pages pages."""
 
 
-def query_dataframe(subscriptions: Iterable[str], query: str, max_pages = 10) -> DataFrame:
-    responses = _query_native(subscriptions, query, max_pages)
-    
-    columns = [KustoColumnDescriptor(c['name'], _RESOURCE_GRAPH_TO_KUSTO_TYPE_MAP[c['type']]) for c in responses[0].data['columns']]
-    rows = itertools.chain.from_iterable(r.data['rows'] for r in responses)
+def query_native(
+    subscriptions: Iterable[str],
+    query: str,
+    max_pages=10,
+    shard_size: Optional[int] = None,
+    max_concurrency: int = 1,
+) -> List[QueryResponse]:
+    return _query_native_sharded(subscriptions, query, max_pages, shard_size, max_concurrency)
+
+
+def query_dataframe(
+    subscriptions: Iterable[str],
+    query: str,
+    max_pages=10,
+    cache: Optional[bool] = None,
+    decode_options: Optional[KustoDecodeOptions] = None,
+    shard_size: Optional[int] = None,
+    max_concurrency: int = 1,
+) -> DataFrame:
+    """Query Resource Graph over subscriptions.
 
-    return kusto_data_to_dataframe(columns, rows)
+    With shard_size set the subscriptions are queried in shards of at most that many (ARG accepts
+    up to 1000 per request), max_concurrency at a time. A shard whose result is truncated or needs
+    more than max_pages pages is split in half and queried again.
+    """
+    subscriptions = realize_sequence(subscriptions)
+    result_cache = default_result_cache(cache)
+    if result_cache:
+        cache_key = result_cache_key('resource_graph', query, sorted(subscriptions), options=decode_options)
+        tables = result_cache.get(cache_key)
+        if tables is not None:
+            return tables[0]
+
+    responses = _query_native_sharded(subscriptions, query, max_pages, shard_size, max_concurrency)
+
+    # Pages of different shards can describe their columns differently (e.g. an empty shard), so
+    # runs of pages with the same columns are decoded together and then concatenated.
+    dataframes = []
+    for response_columns, column_responses in itertools.groupby(responses, key=lambda r: r.data['columns']):
+        columns = [
+            KustoColumnDescriptor(c['name'], _RESOURCE_GRAPH_TO_KUSTO_TYPE_MAP[c['type']])
+            for c in response_columns
+        ]
+        rows = itertools.chain.from_iterable(r.data['rows'] for r in column_responses)
+        dataframes.append(kusto_data_to_dataframe(columns, rows, decode_options))
+    dataframe = dataframes[0] if len(dataframes) == 1 else concat(dataframes, ignore_index=True)
+    if result_cache:
+        result_cache.put(cache_key, [dataframe])
+    return dataframe
 
 
 _RESOURCE_GRAPH_TO_KUSTO_TYPE_MAP = {
@@ -30,25 +76,60 @@ _RESOURCE_GRAPH_TO_KUSTO_TYPE_MAP = {
 }
 
 
+_MAX_SUBSCRIPTIONS_PER_REQUEST = 1000
+
+
+def _query_native_sharded(
+    subscriptions: Iterable[str], query: str, max_pages, shard_size: Optional[int], max_concurrency: int
+) -> List[QueryResponse]:
+    subscriptions = realize_sequence(subscriptions)
+    if shard_size is None:
+        if len(subscriptions) <= _MAX_SUBSCRIPTIONS_PER_REQUEST:
+            return _query_native(subscriptions, query, max_pages)
+        shard_size = _MAX_SUBSCRIPTIONS_PER_REQUEST
+
+    shard_size = min(shard_size, _MAX_SUBSCRIPTIONS_PER_REQUEST)
+    shards = [subscriptions[i:i + shard_size] for i in range(0, len(subscriptions), shard_size)]
+    query_shard = functools.partial(_query_shard, query=query, max_pages=max_pages)
+    return [
+        response for responses in map_bounded(query_shard, shards, max_concurrency) for response in responses
+    ]
+
+
+def _query_shard(subscriptions: Sequence[str], query: str, max_pages) -> List[QueryResponse]:
+    try:
+        return _query_native(subscriptions, query, max_pages)
+    except ResourceGraphResultTooLargeError:
+        if len(subscriptions) == 1:
+            raise
+    half = len(subscriptions) // 2
+    return _query_shard(subscriptions[:half], query, max_pages) + _query_shard(
+        subscriptions[half:], query, max_pages
+    )
+
+
 def _query_native(subscriptions: Iterable[str], query: str, max_pages) -> List[QueryResponse]:
     client = default_sdk_client(ResourceGraphClient)
+    subscriptions = realize_sequence(subscriptions)
     query_options = QueryRequestOptions()
-    query_request = QueryRequest(subscriptions=realize_sequence(subscriptions), query=query, options=query_options)
-    query_response: QueryResponse = client.resources(query_request)
+    query_request = QueryRequest(subscriptions=subscriptions, query=query, options=query_options)
+    query_response: QueryResponse = scheduled_call(
+        ApiFamily.resource_graph, lambda: client.resources(query_request)
+    )
 
     if query_response.result_truncated is ResultTruncated.true:
-        raise RuntimeError("results are truncated. project id to enable paging.")
+        raise ResourceGraphResultTooLargeError("results are truncated. project id to enable paging.")
 
     if query_response.skip_token:
         page_size = query_response.count
         if query_response.total_records > page_size * max_pages:
-            raise RuntimeError("too many results. increase max pages.")
+            raise ResourceGraphResultTooLargeError("too many results. increase max pages.")
     
     responses = [query_response]
     while query_response.skip_token:
         query_options = QueryRequestOptions(skip_token=query_response.skip_token)
         query_request = QueryRequest(subscriptions=subscriptions, query=query, options=query_options)
-        query_response = client.resources(query_request)
+        query_response = scheduled_call(ApiFamily.resource_graph, lambda: client.resources(query_request))
         responses.append(query_response)
 
     return responses
\ No newline at end of file
@@ -1,9 +1,15 @@
 from azmeta.access.utils.sdk import default_sdk_client
 from azure.mgmt.compute import ComputeManagementClient
 from azure.mgmt.compute.models import ResourceSku
-from typing import Dict, NamedTuple, Callable, Any, Mapping, Optional, Iterable, List, Collection
+from typing import Dict, NamedTuple, Callable, Any, Mapping, Optional, Iterable, List, Collection, Tuple
 from logging import Logger
+import os
 import re
+import threading
+import time
+from .config import direct
+from .utils.storage import read_pickle, write_pickle
+from .utils.throttling import ApiFamily, scheduled_call
 
 
 class VirtualMachineCapabilities(NamedTuple):
@@ -82,8 +88,16 @@ class ManagedDiskSku(NamedTuple):
 
 class AzureComputeSpecifications:
     def __init__(self):
-        self._virtual_machine_skus: Dict[str, VirtualMachineSku]  = {}
-        self._managed_disk_skus: Dict[str, ManagedDiskSku] = {}
+        # Both lookups are held in one tuple so a background refresh can replace them together.
+        self._skus: Tuple[Dict[str, VirtualMachineSku], Dict[str, ManagedDiskSku]] = ({}, {})
+
+    @property
+    def _virtual_machine_skus(self) -> Dict[str, VirtualMachineSku]:
+        return self._skus[0]
+
+    @property
+    def _managed_disk_skus(self) -> Dict[str, ManagedDiskSku]:
+        return self._skus[1]
 
     @property
     def virtual_machine_skus(self) -> Collection[VirtualMachineSku]:
@@ -100,9 +114,84 @@ class AzureComputeSpecifications:
         return self._managed_disk_skus[size.lower()]
 
 
-def load_compute_specifications(logger: Logger) -> AzureComputeSpecifications:
+def load_compute_specifications(logger: Logger, cache: Optional[bool] = None) -> AzureComputeSpecifications:
+    """Load the VM and managed disk SKU specifications from ARM.
+
+    With the specifications cache enabled (azmeta.specifications_cache, off by default) the built
+    specifications are kept in a pickle file. A cached copy older than max_age_seconds is still
+    returned, and is refreshed on a background thread that swaps the new SKUs into the returned
+    object when done. Only one refresh per cache file runs at a time.
+    """
+    settings = direct()['azmeta']['specifications_cache']
+    if cache is None:
+        cache = settings['enabled'].get(bool)
+    if not cache:
+        return _build_compute_specifications(logger)
+
+    if settings['path'].get() is None:
+        path = os.path.join(direct().config_dir(), 'specifications.pickle')
+    else:
+        path = settings['path'].as_filename()
+    cached = read_pickle(path)
+    if cached is None or cached['version'] != _SPECIFICATIONS_CACHE_VERSION:
+        specifications = _build_compute_specifications(logger)
+        _save_compute_specifications(path, specifications, logger)
+        return specifications
+
+    specifications = AzureComputeSpecifications()
+    specifications._skus = cached['skus']
+    max_age_seconds = settings['max_age_seconds'].get()
+    if max_age_seconds is not None and cached['created'] + max_age_seconds < time.time():
+        with _refresh_lock:
+            waiting = _refresh_waiting.get(path)
+            if waiting is not None:
+                waiting.append(specifications)
+                return specifications
+            _refresh_waiting[path] = [specifications]
+        threading.Thread(target=_refresh_compute_specifications, args=(path, logger), daemon=True).start()
+    return specifications
+
+
+# Cached specifications are rebuilt when the capability fields change.
+_SPECIFICATIONS_CACHE_VERSION = (1, VirtualMachineCapabilities._fields, ManagedDiskCapabilities._fields)
+# Specifications loaded from each cache file while it is being refreshed, to receive the new SKUs.
+_refresh_waiting: Dict[str, List[AzureComputeSpecifications]] = {}
+_refresh_lock = threading.Lock()
+
+
+def _save_compute_specifications(
+    path: str, specifications: AzureComputeSpecifications, logger: Logger
+) -> None:
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_pickle(
+            path,
+            {'version': _SPECIFICATIONS_CACHE_VERSION, 'created': time.time(), 'skus': specifications._skus},
+        )
+    except OSError as error:
+        logger.warning(f'Failed to cache compute specifications in {path}: {error}')
+
+
+def _refresh_compute_specifications(path: str, logger: Logger) -> None:
+    fresh = None
+    try:
+        fresh = _build_compute_specifications(logger)
+        _save_compute_specifications(path, fresh, logger)
+    except Exception:
+        logger.warning('Failed to refresh compute specifications, keeping the cached copy.', exc_info=True)
+    finally:
+        with _refresh_lock:
+            waiting = _refresh_waiting.pop(path)
+    if fresh is not None:
+        for specifications in waiting:
+            specifications._skus = fresh._skus
+
+
+def _build_compute_specifications(logger: Logger) -> AzureComputeSpecifications:
     client = default_sdk_client(ComputeManagementClient)
-    sku_pages: Iterable[ResourceSku] = client.resource_skus.list(filter="location eq 'eastus2'")
+    sku_pages: Iterable[ResourceSku] = scheduled_call(
+        ApiFamily.arm, lambda: list(client.resource_skus.list(filter="location eq 'eastus2'"))
+    )
     specifications = AzureComputeSpecifications()
     for sku in sku_pages:
         if sku.resource_type not in ('virtualMachines', 'disks'):
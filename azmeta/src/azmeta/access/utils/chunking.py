@@ -1,9 +1,17 @@
+import heapq
 import itertools
-from typing import NamedTuple, List, Any, Iterable, Union
+import json
+import math
+import os
+import statistics
+import threading
+from typing import NamedTuple, List, Any, Callable, Dict, Iterable, Optional, Sequence, Tuple, Union
+
+from .storage import read_json, write_json
 
 class ChunkGroup(NamedTuple):
     id: str
-    chunks: List[List[Any]]
+    chunks: List[Tuple[Any, ...]]
 
     def __len__(self):
         return len(self.chunks)
@@ -17,25 +25,171 @@ class GroupedChunkList(NamedTuple):
         return self.total_len
 
 
-def build_grouped_chunk_list(input_data, select_value, select_group_key, chunk_size=8) -> GroupedChunkList:
-    groups = []
+def build_grouped_chunk_list(
+    input_data,
+    select_value,
+    select_group_key,
+    chunk_size: Optional[int] = 8,
+    max_chunk_bytes: Optional[int] = None,
+    presorted: bool = False,
+) -> GroupedChunkList:
+    """Group values by key and split each group into chunks.
+
+    A chunk holds at most chunk_size values and, when max_chunk_bytes is set, at most that many
+    bytes of values as serialized into a KQL dynamic array. A single value over the byte budget
+    gets a chunk of its own. With presorted the input is consumed in one pass without sorting;
+    it should already be grouped by key, but a key that reappears is added to its earlier group.
+    """
+    if chunk_size is None and max_chunk_bytes is None:
+        raise ValueError('chunk_size or max_chunk_bytes is required.')
+
+    groups: Dict[Any, ChunkGroup] = {}
     total_chunks = 0
-    for key, datas in itertools.groupby(sorted(input_data, key=select_group_key), key=select_group_key):
+    if not presorted:
+        input_data = sorted(input_data, key=select_group_key)
+    for key, datas in itertools.groupby(input_data, key=select_group_key):
         values = (select_value(x) for x in datas)
-        chunk_data = list(_chunked_iterable(values, chunk_size))
+        chunk_data = list(_chunked_iterable(values, chunk_size, max_chunk_bytes))
         total_chunks += len(chunk_data)
-        groups.append(ChunkGroup(key, chunk_data))
+        if key in groups:
+            groups[key].chunks.extend(chunk_data)
+        else:
+            groups[key] = ChunkGroup(key, chunk_data)
+
+    return GroupedChunkList(total_chunks, list(groups.values()))
+
+
+def build_cost_balanced_chunk_list(
+    input_data,
+    select_value,
+    select_group_key,
+    select_weight: Callable[[Any], float],
+    chunk_size: Optional[int] = 8,
+    max_chunk_weight: Optional[float] = None,
+) -> GroupedChunkList:
+    """Group values by key and split each group into chunks of roughly equal total weight.
+
+    select_weight gives the expected query cost of a value, for example from
+    ChunkRuntimeHistory.weight or a pre-query of ingested bytes. Each group gets enough chunks to
+    keep at most chunk_size values and, when max_chunk_weight is set, about that much weight per
+    chunk; values are packed heaviest first into the lightest chunk (LPT). Groups and the chunks
+    in them are ordered heaviest first, so the stragglers start before the quick chunks.
+    """
+    if chunk_size is None and max_chunk_weight is None:
+        raise ValueError('chunk_size or max_chunk_weight is required.')
+
+    weighted_groups = []
+    total_chunks = 0
+    for key, datas in itertools.groupby(sorted(input_data, key=select_group_key), key=select_group_key):
+        values = [select_value(x) for x in datas]
+        weighted_chunks = _pack_by_weight(
+            values, [float(select_weight(v)) for v in values], chunk_size, max_chunk_weight
+        )
+        total_chunks += len(weighted_chunks)
+        weighted_groups.append(
+            (weighted_chunks[0][0], ChunkGroup(key, [chunk for _, chunk in weighted_chunks]))
+        )
+
+    weighted_groups.sort(key=lambda g: g[0], reverse=True)
+    return GroupedChunkList(total_chunks, [group for _, group in weighted_groups])
+
+
+def _pack_by_weight(
+    values: List[Any], weights: List[float], size: Optional[int], max_weight: Optional[float]
+) -> List[Tuple[float, Tuple[Any, ...]]]:
+    chunk_count = 1
+    if size is not None:
+        chunk_count = max(chunk_count, _idivceil(len(values), size))
+    if max_weight is not None:
+        chunk_count = max(chunk_count, math.ceil(sum(weights) / max_weight))
+    chunk_count = min(chunk_count, len(values))
+
+    chunks: List[List[Any]] = [[] for _ in range(chunk_count)]
+    chunk_weights = [0.0] * chunk_count
+    # Heap of (weight, index) for the chunks that still have room.
+    open_chunks = [(0.0, index) for index in range(chunk_count)]
+    for value, weight in sorted(zip(values, weights), key=lambda x: x[1], reverse=True):
+        chunk_weight, index = heapq.heappop(open_chunks)
+        chunks[index].append(value)
+        chunk_weights[index] = chunk_weight + weight
+        if size is None or len(chunks[index]) < size:
+            heapq.heappush(open_chunks, (chunk_weights[index], index))
+
+    return sorted(((w, tuple(c)) for w, c in zip(chunk_weights, chunks)), key=lambda x: x[0], reverse=True)
+
+
+class ChunkRuntimeHistory:
+    """Query runtimes per value (resource id) from earlier runs, stored as JSON at path.
+
+    A chunk's runtime is split evenly over its values and blended into each value's stored runtime
+    with an exponential moving average, so the history follows changes in agent chattiness.
+    """
+
+    def __init__(self, path: str, smoothing: float = 0.5):
+        self.path = path
+        self.smoothing = smoothing
+        self._runtimes: Dict[str, float] = read_json(path) or {}
+        self._lock = threading.Lock()
+
+    def record(self, values: Sequence[Any], seconds: float) -> None:
+        share = seconds / max(len(values), 1)
+        with self._lock:
+            for value in values:
+                key = str(value).lower()
+                previous = self._runtimes.get(key)
+                self._runtimes[key] = (
+                    share if previous is None else previous + self.smoothing * (share - previous)
+                )
+
+    def weight(self, value: Any, default: Optional[float] = None) -> float:
+        """The expected runtime of value, or default (the median known runtime when None)."""
+        with self._lock:
+            runtime = self._runtimes.get(str(value).lower())
+            if runtime is not None:
+                return runtime
+            if default is not None:
+                return default
+            return statistics.median(self._runtimes.values()) if self._runtimes else 1.0
+
+    def save(self) -> None:
+        with self._lock:
+            runtimes = dict(self._runtimes)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        write_json(self.path, runtimes)
+
+
+def _chunked_iterable(iterable, size: Optional[int], max_bytes: Optional[int] = None):
+    if max_bytes is None:
+        it = iter(iterable)
+        while True:
+            chunk = tuple(itertools.islice(it, size))
+            if not chunk:
+                break
+            yield chunk
+        return
+
+    pending: List[Any] = []
+    pending_bytes = _EMPTY_ARRAY_BYTES
+    for value in iterable:
+        value_bytes = _serialized_bytes(value) + (_SEPARATOR_BYTES if pending else 0)
+        if pending and (pending_bytes + value_bytes > max_bytes or len(pending) == size):
+            yield tuple(pending)
+            pending = []
+            pending_bytes = _EMPTY_ARRAY_BYTES
+            value_bytes -= _SEPARATOR_BYTES
+        pending.append(value)
+        pending_bytes += value_bytes
+    if pending:
+        yield tuple(pending)
+
 
-    return GroupedChunkList(total_chunks, groups)
+def _serialized_bytes(value: Any) -> int:
+    # Matches serialize_to_kql, which writes sequences as dynamic(<json array>).
+    return len(json.dumps(value).encode('utf-8'))
 
 
-def _chunked_iterable(iterable, size):
-    it = iter(iterable)
-    while True:
-        chunk = tuple(itertools.islice(it, size))
-        if not chunk:
-            break
-        yield chunk
+_EMPTY_ARRAY_BYTES = len('dynamic([])')
+_SEPARATOR_BYTES = len(', ')
         
 
 def _idivceil(n, d):
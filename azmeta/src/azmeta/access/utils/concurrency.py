@@ -0,0 +1,93 @@
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from itertools import zip_longest
+from typing import Any, Callable, Deque, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def imap_bounded(
+    func: Callable[[T], R],
+    items: Iterable[T],
+    max_concurrency: int = 1,
+    select_group_key: Optional[Callable[[T], Hashable]] = None,
+    max_per_group: Optional[int] = None,
+) -> Iterator[R]:
+    """Apply func to items on a thread pool, yielding results in input order.
+
+    At most max_concurrency calls run at once and, when select_group_key is given, at most
+    max_per_group calls per group key. Items start in input order, skipping groups that are at
+    their limit. Results that finish out of order are held until their turn; no more than
+    2 * max_concurrency results are held or running at once (the next result to yield can always
+    start), which bounds their memory. Since results are yielded in input order, items of
+    different groups should be interleaved (see interleave_groups) for max_per_group not to limit
+    the overall concurrency.
+    """
+    if max_concurrency <= 1:
+        yield from map(func, items)
+        return
+
+    work = list(items)
+    window = max_concurrency * 2
+    queues: Dict[Hashable, Deque[int]] = {}
+    for index, item in enumerate(work):
+        key = select_group_key(item) if select_group_key else None
+        queues.setdefault(key, deque()).append(index)
+
+    running: Counter = Counter()
+    futures: Dict[Future, Tuple[int, Hashable]] = {}
+    results: Dict[int, R] = {}
+    next_index = 0
+
+    def can_start(key: Hashable) -> bool:
+        queue = queues[key]
+        return (
+            bool(queue)
+            and (queue[0] == next_index or len(futures) + len(results) < window)
+            and (max_per_group is None or running[key] < max_per_group)
+        )
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        while next_index < len(work):
+            while len(futures) < max_concurrency:
+                startable = [key for key in queues if can_start(key)]
+                if not startable:
+                    break
+                key = min(startable, key=lambda k: queues[k][0])
+                index = queues[key].popleft()
+                futures[executor.submit(func, work[index])] = (index, key)
+                running[key] += 1
+
+            if next_index in results:
+                yield results.pop(next_index)
+                next_index += 1
+                continue
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, key = futures.pop(future)
+                running[key] -= 1
+                results[index] = future.result()
+
+
+def interleave_groups(items: Iterable[T], select_group_key: Callable[[T], Hashable]) -> List[T]:
+    """Reorder items round-robin across their groups, keeping the order within each group."""
+    groups: Dict[Hashable, List[T]] = {}
+    for item in items:
+        groups.setdefault(select_group_key(item), []).append(item)
+    rounds = zip_longest(*groups.values(), fillvalue=_MISSING)
+    return [item for round_items in rounds for item in round_items if item is not _MISSING]
+
+
+_MISSING: Any = object()
+
+
+def map_bounded(
+    func: Callable[[T], R],
+    items: Iterable[T],
+    max_concurrency: int = 1,
+    select_group_key: Optional[Callable[[T], Hashable]] = None,
+    max_per_group: Optional[int] = None,
+) -> List[R]:
+    return list(imap_bounded(func, items, max_concurrency, select_group_key, max_per_group))
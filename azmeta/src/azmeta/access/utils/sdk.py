@@ -1,4 +1,7 @@
-from typing import Optional, Type, TypeVar
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Optional, Tuple, Type, TypeVar
+from azmeta.access.config import direct
 from azmeta.access.context import default_resource_context, default_authentication_context
 from inspect import getfullargspec
 
@@ -6,20 +9,74 @@ from inspect import getfullargspec
 T = TypeVar('T')
 
 
-def default_sdk_client(client_class: Type[T], auth_resource: Optional[str] = None, subscription_id: Optional[str] = None) -> T:
+def default_sdk_client(
+    client_class: Type[T],
+    auth_resource: Optional[str] = None,
+    subscription_id: Optional[str] = None,
+    pooled: bool = True,
+) -> T:
     resource_context = default_resource_context()
-    auth_context = default_authentication_context()
 
     if subscription_id is None:    
         subscription_id = resource_context.default_subscription.subscription_id
-    credential = _SdkCredential(auth_context, auth_resource if auth_resource else "https://management.core.windows.net/")
+    if auth_resource is None:
+        auth_resource = "https://management.core.windows.net/"
+
+    if not pooled:
+        return _create_client(client_class, auth_resource, subscription_id)
+    return _client_pool.get(client_class, auth_resource, subscription_id)
+
+
+def clear_sdk_client_pool() -> None:
+    _client_pool.clear()
+
+
+def _create_client(client_class, auth_resource: str, subscription_id: str):
+    credential = _SdkCredential(default_authentication_context(), auth_resource)
     parameters = {
         'subscription_id': subscription_id,
         'credentials': credential,
         'credential': credential
     }
 
-    return _instantiate_client(client_class, **parameters)
+    client = _instantiate_client(client_class, **parameters)
+    config = getattr(client, 'config', None)
+    if config is not None and hasattr(config, 'keep_alive'):
+        # msrest closes the (thread-local) requests session after every call unless keep_alive is set.
+        config.keep_alive = True
+    return client
+
+
+class _ClientPool:
+    """Clients shared by (client_class, subscription_id, auth_resource), least recently used evicted first."""
+
+    def __init__(self):
+        self._clients: 'OrderedDict[Tuple[type, str, str], Any]' = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, client_class, auth_resource: str, subscription_id: str):
+        key = (client_class, subscription_id, auth_resource)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is not None:
+                self._clients.move_to_end(key)
+                return client
+
+        client = _create_client(client_class, auth_resource, subscription_id)
+        with self._lock:
+            client = self._clients.setdefault(key, client)
+            self._clients.move_to_end(key)
+            pool_size = direct()['azmeta']['sdk']['client_pool_size'].get(int)
+            while len(self._clients) > pool_size:
+                self._clients.popitem(last=False)
+        return client
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clients.clear()
+
+
+_client_pool = _ClientPool()
 
 
 def _instantiate_client(client_class, **kwargs):
@@ -38,8 +95,9 @@ class _SdkCredential:
         self._credential = credential
         self._resource = resource
 
-    def get_token(self, *scopes):
-        return self._credential.get_token(*scopes)
+    def get_token(self, *scopes, **kwargs):
+        # azure-core TokenCredential protocol, forwarded to the authentication context.
+        return self._credential.get_token(list(scopes), tenant_id=kwargs.get('tenant_id'))
 
     def signed_session(self, session=None):
         token = self.get_token(self._resource)
@@ -0,0 +1,45 @@
+import math
+from typing import List, Sequence
+import numpy
+from pandas import DataFrame
+
+# Log-bucketed quantile sketch (as in DDSketch). A value v != 0 lands in bucket
+# ceil(log(|v|) / log(gamma)) with gamma = (1 + a) / (1 - a); reporting a bucket by its midpoint
+# 2 * gamma^k / (gamma + 1) keeps every quantile within relative accuracy a. Sketches are plain
+# (sign, bucket, samples) counts, so they merge exactly by summing samples.
+
+
+def sketch_log_gamma(relative_accuracy: float) -> float:
+    return math.log((1 + relative_accuracy) / (1 - relative_accuracy))
+
+
+def sketch_percentiles(
+    sketch: DataFrame, key_columns: List[str], percentiles: Sequence[int], relative_accuracy: float
+) -> DataFrame:
+    """Merge sketch rows (key_columns, sign, bucket, samples, max) and estimate percentiles per key.
+
+    Returns one row per key with percentile_<p>th columns, the exact max and the total samples.
+    """
+    merged = (
+        sketch.groupby(key_columns + ['sign', 'bucket'], sort=False)
+        .agg({'samples': 'sum', 'max': 'max'})
+        .reset_index()
+    )
+    log_gamma = sketch_log_gamma(relative_accuracy)
+    gamma = math.exp(log_gamma)
+    bucket = merged['bucket'].to_numpy(dtype='float64')
+    merged['value'] = (
+        merged['sign'].to_numpy(dtype='float64') * 2 * numpy.exp(bucket * log_gamma) / (gamma + 1)
+    )
+    merged = merged.sort_values(key_columns + ['value'], kind='mergesort')
+
+    grouped = merged.groupby(key_columns, sort=True)
+    cumulative = grouped['samples'].cumsum()
+    totals = grouped['samples'].transform('sum')
+    result = DataFrame(index=grouped.size().index)
+    for percentile in percentiles:
+        reached = merged[cumulative >= totals * (percentile / 100)]
+        result[f'percentile_{percentile}th'] = reached.groupby(key_columns, sort=True)['value'].first()
+    result['max'] = grouped['max'].max()
+    result['samples'] = grouped['samples'].sum()
+    return result.reset_index()
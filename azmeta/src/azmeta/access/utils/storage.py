@@ -0,0 +1,84 @@
+import json
+import os
+import pickle
+import threading
+from typing import Any, List, Optional, Sequence
+from pandas import DataFrame
+from pandas.api.types import infer_dtype
+
+# Parquet support comes from pyarrow, which is only needed when results are persisted.
+
+_JSON_COLUMNS_KEY = b'azmeta.json_columns'
+
+
+def write_dataframe(path: str, dataframe: DataFrame) -> None:
+    """Write a DataFrame to a Parquet file, replacing any existing file atomically.
+
+    Object columns (parsed Kusto dynamic values) are stored as JSON text and restored by read_dataframe.
+    Columns holding only strings are stored as Parquet strings so read filters can match them.
+    """
+    import pyarrow
+    import pyarrow.parquet
+
+    json_columns = [
+        name
+        for name, dtype in dataframe.dtypes.items()
+        if dtype == object and infer_dtype(dataframe[name], skipna=True) not in ('string', 'empty')
+    ]
+    if json_columns:
+        dataframe = dataframe.assign(
+            **{name: dataframe[name].map(json.dumps, na_action='ignore') for name in json_columns}
+        )
+    table = pyarrow.Table.from_pandas(dataframe, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[_JSON_COLUMNS_KEY] = json.dumps(json_columns).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    temp_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+    pyarrow.parquet.write_table(table, temp_path)
+    os.replace(temp_path, path)
+
+
+def read_dataframe(
+    path: str, columns: Optional[Sequence[str]] = None, filters: Optional[List[Any]] = None
+) -> DataFrame:
+    import pyarrow.parquet
+
+    table = pyarrow.parquet.read_table(path, columns=columns, filters=filters)
+    json_columns = json.loads((table.schema.metadata or {}).get(_JSON_COLUMNS_KEY, b'[]'))
+    dataframe = table.to_pandas()
+    for name in json_columns:
+        if name in dataframe:
+            dataframe[name] = dataframe[name].map(json.loads, na_action='ignore')
+    return dataframe
+
+
+def write_json(path: str, value: Any) -> None:
+    temp_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(value, file)
+    os.replace(temp_path, path)
+
+
+def read_json(path: str) -> Optional[Any]:
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def write_pickle(path: str, value: Any) -> None:
+    temp_path = f'{path}.{os.getpid()}-{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as file:
+        pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+
+def read_pickle(path: str) -> Optional[Any]:
+    # Pickles written by another version of the package may reference names that no longer exist.
+    try:
+        with open(path, 'rb') as file:
+            return pickle.load(file)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
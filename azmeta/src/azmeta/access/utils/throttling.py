@@ -0,0 +1,205 @@
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from enum import Enum
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple, TypeVar
+
+from azmeta.access.config import direct
+
+T = TypeVar('T')
+
+
+class ApiFamily(str, Enum):
+    arm = 'arm'
+    resource_graph = 'resource_graph'
+    cost_management = 'cost_management'
+    log_analytics = 'log_analytics'
+
+
+class ThrottledError(Exception):
+    def __init__(self, family: ApiFamily, status_code: int):
+        super().__init__(f'{family.value} requests are still throttled (HTTP {status_code}) after retrying.')
+        self.status_code = status_code
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def limit(self, remaining: int) -> None:
+        # The service reported how many requests are left in its window; never burst past that.
+        with self._lock:
+            self._tokens = min(self._tokens, max(remaining - 1, 0))
+
+
+class RequestScheduler:
+    """Paces and retries calls to Azure APIs with a token bucket per (API family, tenant).
+
+    Throttled responses (429/503) are retried after the service's Retry-After, or after a jittered
+    exponential backoff, and pause every caller sharing the bucket. Remaining-quota headers on
+    successful responses cap the bucket so fan-out slows down before the quota runs out.
+    """
+
+    def __init__(self, settings: Optional[Mapping[str, Any]] = None):
+        self._settings = settings if settings is not None else direct()['azmeta']['throttling'].flatten()
+        self._buckets: Dict[Tuple[ApiFamily, Optional[str]], _TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def call(self, family: ApiFamily, func: Callable[[], T], tenant_id: Optional[str] = None) -> T:
+        bucket = self._bucket(family, tenant_id)
+        max_retries = self._settings['max_retries']
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                result = func()
+                response = _response_of(result)
+            except Exception as error:
+                response = getattr(error, 'response', None)
+                if _status_code(response, error) not in _THROTTLED_STATUS_CODES or attempt == max_retries:
+                    raise
+            else:
+                status_code = _status_code(response)
+                if status_code not in _THROTTLED_STATUS_CODES:
+                    if response is not None:
+                        self._observe(bucket, response)
+                    return result
+                if attempt == max_retries:
+                    raise ThrottledError(family, status_code)  # type: ignore
+
+            delay = _retry_after(response)
+            if delay is None:
+                delay = self.backoff_delay(attempt)
+            bucket.pause(delay)
+            attempt += 1
+
+    def backoff_delay(self, attempt: int) -> float:
+        delay = min(
+            self._settings['backoff_max_seconds'], self._settings['backoff_base_seconds'] * 2**attempt
+        )
+        return delay * random.uniform(0.5, 1.0)
+
+    def _bucket(self, family: ApiFamily, tenant_id: Optional[str]) -> _TokenBucket:
+        key = (family, tenant_id)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                family_settings = self._settings[family.value]
+                bucket = _TokenBucket(family_settings['rate'], family_settings['burst'])
+                self._buckets[key] = bucket
+            return bucket
+
+    def _observe(self, bucket: _TokenBucket, response: Any) -> None:
+        headers = _headers(response)
+        remaining = None
+        for name, value in headers.items():
+            name = name.lower()
+            if name.startswith('x-ms-ratelimit-remaining') or name.endswith('-remaining'):
+                # Either a bare count or comma separated name;count (or name=count) pairs whose
+                # names can contain digits, e.g. Microsoft.Compute/HighCostGet3Min;159.
+                counts = [int(x) for x in re.findall(r'(?:^|[;=])\s*(\d+)\s*(?=,|$)', value.strip())]
+                if counts and (remaining is None or min(counts) < remaining):
+                    remaining = min(counts)
+        if remaining is None:
+            return
+        bucket.limit(remaining)
+        if remaining == 0:
+            resets_after = _parse_duration(headers.get('x-ms-user-quota-resets-after'))
+            bucket.pause(resets_after if resets_after is not None else self.backoff_delay(0))
+
+
+def default_request_scheduler() -> RequestScheduler:
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = RequestScheduler()
+        return _default_scheduler
+
+
+def scheduled_call(family: ApiFamily, func: Callable[[], T]) -> T:
+    return default_request_scheduler().call(family, func, _default_tenant_id())
+
+
+def _default_tenant_id() -> Optional[str]:
+    from azmeta.access.context import default_resource_context
+    return default_resource_context().default_subscription.tenant_id
+
+
+_default_scheduler: Optional[RequestScheduler] = None
+_default_scheduler_lock = threading.Lock()
+_THROTTLED_STATUS_CODES = (429, 503)
+
+
+def _response_of(result: Any) -> Any:
+    # requests.Response from a raw service_client.send, or the response behind a ClientRawResponse.
+    if hasattr(result, 'status_code') and hasattr(result, 'headers'):
+        return result
+    return getattr(result, 'response', None)
+
+
+def _status_code(response: Any, error: Any = None) -> Optional[int]:
+    status_code = getattr(response, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(error, 'status_code', None)
+    return status_code
+
+
+def _headers(response: Any) -> Mapping[str, str]:
+    return getattr(response, 'headers', None) or {}
+
+
+def _retry_after(response: Any) -> Optional[float]:
+    delays = []
+    for name, value in _headers(response).items():
+        if name.lower().endswith('retry-after'):
+            delay = _parse_retry_after(value)
+            if delay is not None:
+                delays.append(delay)
+    return max(delays) if delays else None
+
+
+def _parse_retry_after(value: str) -> Optional[float]:
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return _parse_duration(value)
+
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    # hh:mm:ss, as used by x-ms-user-quota-resets-after.
+    if not value:
+        return None
+    match = re.fullmatch(r'(\d+):(\d+):(\d+(?:\.\d+)?)', value.strip())
+    if match is None:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)